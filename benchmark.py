@@ -0,0 +1,252 @@
+"""Benchmarks for the parser. Run this module directly to measure parser
+   throughput over synthetic (and optionally recorded) workloads, the
+   results are written as JSON so they can be compared between versions.
+   These are not part of the unittests."""
+
+import argparse
+import gc
+import itertools
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+import parser
+import screen
+import server
+
+def legacy_parse_escape_args(seq, defaults):
+    """The original generator based version of Parser.parse_escape_args,
+       kept as a baseline to compare against."""
+    if len(seq) == 1:
+        splt = ()
+    else:
+        splt = seq[1:].split(b';')
+    if len(splt) > len(defaults):
+        raise parser.ParseException("Too many escape sequence arguments")
+    for tok, dflt in itertools.zip_longest(splt, defaults):
+        tok = b"" if tok is None else tok.strip()
+        if not tok:
+            yield dflt
+        else:
+            try:
+                num = int(tok, 10)
+                if num < 0:
+                    raise parser.ParseException("Escape sequence argument must be positive")
+                yield num
+            except ValueError as exc:
+                raise parser.ParseException("Non-numeric escape sequence argument: "+
+                                            str(tok)) from exc
+
+# Typical escape sequences from nethack, with the defaults their handlers use
+ESCAPE_ARGS_CASES = (
+    (bytearray(b'[1;0;1234;0'), (None, None, None, None)), # tiledata start glyph
+    (bytearray(b'[1;1'), (None, None, None, None)), # tiledata end glyph
+    (bytearray(b'[12;40'), (1, 1)), # cursor position
+    (bytearray(b'[31'), (0,)), # sgr
+    (bytearray(b'['), (0,)), # erase line
+)
+
+def bench_escape_args(number=100000):
+    """Time parsing all the ESCAPE_ARGS_CASES number times with the legacy
+       generator, the uncached scanner and the cached parser. Returns a dict
+       of name -> seconds."""
+    parser_ = parser.Parser()
+    funcs = (('legacy', lambda seq, defaults: tuple(legacy_parse_escape_args(seq, defaults))),
+             ('uncached', lambda seq, defaults: parser_._scan_escape_args( # pylint: disable=protected-access
+                 bytes(seq), defaults)),
+             ('cached', parser_.parse_escape_args))
+    results = dict()
+    for (name, func) in funcs:
+        def run(func=func):
+            """Parse each case once"""
+            for (seq, defaults) in ESCAPE_ARGS_CASES:
+                func(seq, defaults)
+        results[name] = timeit.timeit(run, number=number)
+    return results
+
+# Version of the JSON results format
+RESULTS_VERSION = 4
+
+# Size of the chunks workloads are fed to the parser in, about what a read
+# from the pty returns
+CHUNK_SIZE = 4096
+
+END_OF_DATA = b'\x1b[1;3z'
+
+def tiledata_redraw_workload():
+    """A full redraw of the map window with tiledata, the way nethack draws
+       it: a tile escape, colors and a character for every map cell."""
+    out = bytearray(b'\x1b[1;2;3z')
+    for y in range(2, 23):
+        out += b'\x1b[%d;1H' % y
+        for x in range(1, screen.COLUMNS):
+            glyph = 2000 + (x * 7 + y * 13) % 400
+            out += b'\x1b[1;0;%d;0z\x1b[%dm%c\x1b[0m\x1b[1;1z' % (glyph, 30 + glyph % 8,
+                                                                 33 + glyph % 90)
+    return bytes(out + END_OF_DATA)
+
+def sgr_status_workload():
+    """The two status lines, with attributes changing around each field."""
+    out = bytearray(b'\x1b[1;2;2z')
+    for _ in range(10):
+        out += b'\x1b[23;1H\x1b[K'
+        for word in (b'Agent', b'the', b'Stripling', b'St:18/02', b'Dx:14', b'Co:18',
+                     b'In:7', b'Wi:10', b'Ch:8', b'Neutral'):
+            out += b'\x1b[1m\x1b[32m' + word + b'\x1b[0m '
+        out += b'\x1b[24;1H\x1b[K'
+        for word in (b'Dlvl:1', b'$:0', b'HP:16(16)', b'Pw:2(2)', b'AC:6', b'Xp:1/0',
+                     b'T:1'):
+            out += b'\x1b[7m\x1b[31m' + word + b'\x1b[27m\x1b[39m '
+    return bytes(out + END_OF_DATA)
+
+def cursor_motion_workload():
+    """Lots of cursor movement with a single character written at each stop."""
+    out = bytearray(b'\x1b[1;2;1z')
+    for i in range(2000):
+        out += b'\x1b[%d;%dH.' % (i % screen.ROWS + 1, i * 7 % screen.COLUMNS + 1)
+        out += b'\x1b[%dA\x1b[%dC*\x1b[B\x1b[D\b\r' % (i % 3 + 1, i % 5 + 1)
+    return bytes(out + END_OF_DATA)
+
+def clear_screen_workload():
+    """Fill the screen with text and clear it again, with whole screen and
+       line erases."""
+    out = bytearray()
+    for _ in range(5):
+        out += b'\x1b[H'
+        for y in range(1, screen.ROWS + 1):
+            out += b'\x1b[%d;1H' % y + b'x' * screen.COLUMNS
+        out += b'\x1b[2J'
+        for y in range(1, screen.ROWS + 1):
+            out += b'\x1b[%d;1H' % y + b'y' * 40 + b'\x1b[K\x1b[1K\x1b[2K'
+    return bytes(out + END_OF_DATA)
+
+SYNTHETIC_WORKLOADS = (
+    ('tiledata_redraw', tiledata_redraw_workload),
+    ('sgr_status', sgr_status_workload),
+    ('cursor_motion', cursor_motion_workload),
+    ('clear_screen', clear_screen_workload),
+)
+
+def chunked(data):
+    """Split data into CHUNK_SIZE chunks, like reads from the pty"""
+    return [data[i:i+CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+def recorded_workload(path):
+    """The chunks read in a session log (see server.RecordingNethack)"""
+    log = server.SessionLog(path)
+    return [bytes(data) for (direction, _, data) in
+            (log[i] for i in range(len(log))) if direction == server.LOG_READ]
+
+def _parse_chunks(parser_, chunks):
+    """Internal function: parse the chunks and return the number of frames"""
+    frames = 0
+    for chunk in chunks:
+        parser_.parse_bytes(chunk)
+        for _ in parser_.screen.iter_frames():
+            frames += 1
+    return frames
+
+def measure_memory(chunks, repeat, tokenize=False):
+    """Measure the memory held by a parser that has already parsed the
+       chunks once, parsing them repeat more times. Returns a dict of:
+       retained_blocks_per_escape - the growth in sys.getallocatedblocks over
+       the loop per escape sequence, memory kept after parsing. This should
+       be 0.
+       working_peak_bytes - the most memory (from tracemalloc) held at any
+       point during the loop above what was held once it finished. This
+       should stay around the size of a chunk however many escapes there are.
+       Neither of these counts allocations: memory that is allocated and freed
+       again straight away doesn't show up. Each escape still allocates a few
+       short lived objects that way, the bytes copy of the sequence that
+       _dispatch_escape hands on and the escape args cache lookup key."""
+    parser_ = parser.Parser(tokenize)
+    _parse_chunks(parser_, chunks)
+    escapes = sum(chunk.count(0x1b) for chunk in chunks) * repeat
+    gc.collect()
+    before = sys.getallocatedblocks()
+    for _ in range(repeat):
+        _parse_chunks(parser_, chunks)
+    gc.collect()
+    retained = (sys.getallocatedblocks() - before) / max(escapes, 1)
+
+    # tracemalloc allocates blocks of its own, so measure the peak separately
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        for _ in range(repeat):
+            _parse_chunks(parser_, chunks)
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'retained_blocks_per_escape': retained,
+            'working_peak_bytes': peak - current}
+
+def bench_workload(chunks, repeat, tokenize=False):
+    """Parse the chunks repeat times with one parser. Returns a dict of the
+       bytes and frames parsed, the seconds it took, the rates, and the peak
+       memory of a new parser (and its ScreenData) parsing the chunks once,
+       plus the measure_memory results.
+       tokenize - passed on to the Parser"""
+    tracemalloc.start()
+    try:
+        _parse_chunks(parser.Parser(tokenize), chunks)
+        (_, peak_memory) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    parser_ = parser.Parser(tokenize)
+    frames = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        frames += _parse_chunks(parser_, chunks)
+    seconds = time.perf_counter() - start
+    num_bytes = sum(len(chunk) for chunk in chunks) * repeat
+    results = {'bytes': num_bytes,
+               'frames': frames,
+               'seconds': seconds,
+               'bytes_per_sec': num_bytes / seconds,
+               'frames_per_sec': frames / seconds,
+               'peak_memory_bytes': peak_memory}
+    results.update(measure_memory(chunks, repeat, tokenize))
+    return results
+
+def run_benchmarks(repeat=20, logs=(), escape_args_number=100000, tokenize=False):
+    """Run the synthetic workloads, plus recorded ones from the session log
+       paths in logs, and the escape argument microbenchmark. Returns the
+       results as a JSON-ready dict.
+       tokenize - if True use the tokenizer mode of the parser"""
+    workloads = dict()
+    for (name, func) in SYNTHETIC_WORKLOADS:
+        workloads[name] = bench_workload(chunked(func()), repeat, tokenize)
+    for path in logs:
+        workloads['recorded:'+path] = bench_workload(recorded_workload(path), repeat, tokenize)
+    return {'version': RESULTS_VERSION,
+            'python': platform.python_version(),
+            'repeat': repeat,
+            'tokenize': tokenize,
+            'workloads': workloads,
+            'escape_args': bench_escape_args(escape_args_number)}
+
+def main(argv):
+    """Command line entry point"""
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--repeat', type=int, default=20,
+                            help='times to parse each workload')
+    arg_parser.add_argument('--output', help='write the JSON here instead of stdout')
+    arg_parser.add_argument('--tokenize', action='store_true',
+                            help='use the tokenizer mode of the parser')
+    arg_parser.add_argument('logs', nargs='*', help='session logs to use as workloads')
+    args = arg_parser.parse_args(argv)
+    results = run_benchmarks(args.repeat, args.logs, tokenize=args.tokenize)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file_:
+            json.dump(results, file_, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
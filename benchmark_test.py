@@ -0,0 +1,63 @@
+"""Smoke tests for the benchmark module, to keep it working as the parser
+   changes. These don't check any timings."""
+
+import json
+import os
+import tempfile
+import unittest
+
+import benchmark
+import parser
+import server
+
+class TestBenchmark(unittest.TestCase):
+    """Run the benchmarks with as little work as possible."""
+
+    def test_workloads(self):
+        """Every synthetic workload parses as exactly one frame, the same in both modes."""
+        for (name, func) in benchmark.SYNTHETIC_WORKLOADS:
+            parser_ = parser.Parser()
+            chunks = benchmark.chunked(func())
+            self.assertEqual(1, benchmark._parse_chunks(parser_, chunks), name) # pylint: disable=protected-access
+            self.assertTrue(parser_.end_of_data, name)
+            tokenizer = parser.Parser(tokenize=True)
+            self.assertEqual(1, benchmark._parse_chunks(tokenizer, chunks), name) # pylint: disable=protected-access
+            self.assertEqual(parser_.screen.snapshot(), tokenizer.screen.snapshot(), name)
+
+    def test_memory(self):
+        """Once warmed up, parsing doesn't keep memory for escapes, and the
+           memory it holds while parsing doesn't grow with the number of escapes."""
+        for (name, func) in benchmark.SYNTHETIC_WORKLOADS:
+            chunks = benchmark.chunked(func())
+            for tokenize in (False, True):
+                memory = benchmark.measure_memory(chunks, 2, tokenize)
+                self.assertLess(memory['retained_blocks_per_escape'], 0.01, name)
+                self.assertLess(memory['working_peak_bytes'], 4 * benchmark.CHUNK_SIZE, name)
+
+    def test_results(self):
+        """The results cover every workload, including recorded ones, and are JSON."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'session.log')
+            writer = server.SessionLogWriter(path)
+            writer.record(server.LOG_READ, b'hello')
+            writer.record(server.LOG_WRITE, b'x')
+            writer.record(server.LOG_READ, benchmark.END_OF_DATA)
+            writer.close()
+            results = benchmark.run_benchmarks(repeat=1, logs=(path,), escape_args_number=1)
+
+        self.assertEqual(benchmark.RESULTS_VERSION, results['version'])
+        names = [name for (name, _) in benchmark.SYNTHETIC_WORKLOADS] + ['recorded:'+path]
+        self.assertEqual(sorted(names), sorted(results['workloads']))
+        recorded = results['workloads']['recorded:'+path]
+        self.assertEqual((5 + len(benchmark.END_OF_DATA), 1),
+                         (recorded['bytes'], recorded['frames']))
+        for workload in results['workloads'].values():
+            self.assertGreater(workload['bytes_per_sec'], 0)
+            self.assertGreater(workload['peak_memory_bytes'], 0)
+            self.assertIn('retained_blocks_per_escape', workload)
+            self.assertIn('working_peak_bytes', workload)
+        self.assertEqual(['cached', 'legacy', 'uncached'], sorted(results['escape_args']))
+        json.dumps(results)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""NumPy views of the screen contents, for bots and models that want whole
+   windows as arrays rather than iterating over CharData. NumPy is only
+   needed if this module is used, the rest of jotbot doesn't import it."""
+
+import collections
+
+import numpy
+
+import parser
+import screen
+
+# The contents of a window as (ROWS, COLUMNS) arrays indexed [y-1, x-1]
+# chars - uint8 characters, screen.EMPTY_CHAR for empty
+# tile_nums, tile_flags - intc tiledata, screen.EMPTY_TILE for no tile
+# attrs - uint64 attribute bitmaps
+WindowArrays = collections.namedtuple('WindowArrays', ('chars', 'tile_nums', 'tile_flags',
+                                                       'attrs'))
+
+def _view(storage, dtype):
+    """Internal function: a read-only (ROWS, COLUMNS) view of a window storage
+       array, without the unused 0 row and column."""
+    view = numpy.frombuffer(storage, dtype=dtype).reshape(screen.ROWS + 1, screen.STRIDE)
+    view = view[1:, 1:]
+    view.flags.writeable = False
+    return view
+
+def window_arrays(window, copy=False):
+    """Return WindowArrays for the WindowData. These are zero-copy, read-only
+       views of the window storage, so they follow any changes to the window
+       until it is next copied by copy-on-write after a snapshot or restore,
+       at which point they keep showing the old contents. Call this again
+       after a snapshot or restore, or pass copy=True to get arrays that are
+       independent of the window. Windows without tiledata get tile arrays
+       filled with EMPTY_TILE."""
+    chars = _view(window.chars, numpy.uint8)
+    attrs = _view(window.attrs, numpy.uint64)
+    if window.use_tile_data:
+        tile_nums = _view(window.tile_nums, numpy.intc)
+        tile_flags = _view(window.tile_flags, numpy.intc)
+    else:
+        tile_nums = tile_flags = numpy.full((screen.ROWS, screen.COLUMNS), screen.EMPTY_TILE,
+                                            dtype=numpy.intc)
+        tile_nums.flags.writeable = False
+    if copy:
+        return WindowArrays(chars.copy(), tile_nums.copy(), tile_flags.copy(), attrs.copy())
+    return WindowArrays(chars, tile_nums, tile_flags, attrs)
+
+def map_arrays(screen_data, copy=False):
+    """Return WindowArrays for the map window of the ScreenData, see window_arrays."""
+    return window_arrays(screen_data.windows[screen.MAP_WINDOW], copy)
+
+def new_batch(size):
+    """Return WindowArrays of (size, ROWS, COLUMNS) arrays to pass to fill_batch.
+       Allocate these once and reuse them for every step."""
+    shape = (size, screen.ROWS, screen.COLUMNS)
+    return WindowArrays(numpy.zeros(shape, dtype=numpy.uint8),
+                        numpy.full(shape, screen.EMPTY_TILE, dtype=numpy.intc),
+                        numpy.full(shape, screen.EMPTY_TILE, dtype=numpy.intc),
+                        numpy.zeros(shape, dtype=numpy.uint64))
+
+def fill_batch(batch, sources, window=screen.MAP_WINDOW):
+    """Copy the given window of each of sources (Parsers or ScreenDatas) into
+       the batch from new_batch, source i going to batch.chars[i] and so on.
+       Each array is filled straight from the window storage with no
+       intermediate objects. Returns the number of sources, entries of the
+       batch after that are left as they were."""
+    size = len(batch.chars)
+    num = 0
+    for source in sources:
+        if num == size:
+            raise ValueError('More sources than the batch size: '+str(size))
+        if isinstance(source, parser.Parser):
+            source = source.screen
+        win = source.windows[window]
+        batch.chars[num] = _view(win.chars, numpy.uint8)
+        batch.attrs[num] = _view(win.attrs, numpy.uint64)
+        if win.use_tile_data:
+            batch.tile_nums[num] = _view(win.tile_nums, numpy.intc)
+            batch.tile_flags[num] = _view(win.tile_flags, numpy.intc)
+        else:
+            batch.tile_nums[num] = screen.EMPTY_TILE
+            batch.tile_flags[num] = screen.EMPTY_TILE
+        num += 1
+    return num
@@ -0,0 +1,76 @@
+"""unittests for the observe module"""
+
+import unittest
+
+try:
+    import numpy
+    import observe
+except ImportError:
+    numpy = None
+
+import parser
+import screen
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestWindowArrays(unittest.TestCase):
+    """Test the NumPy views of the windows."""
+
+    def setUp(self):
+        self.screen = screen.ScreenData()
+        self.screen.current_window = screen.MAP_WINDOW
+        self.screen.cursor_x = 7
+        self.screen.cursor_y = 3
+        self.screen.set_tile(1234, 2)
+        self.screen.current_attributes.set(screen.ATTR_RED_FG)
+        self.screen.set_char(ord(b'@'))
+
+    def test_map_arrays(self):
+        """The views have the window contents at [y-1, x-1] and follow changes."""
+        arrays = observe.map_arrays(self.screen)
+        for array in arrays:
+            self.assertEqual((screen.ROWS, screen.COLUMNS), array.shape)
+            self.assertFalse(array.flags.writeable)
+        self.assertEqual((ord(b'@'), 1234, 2, 1 << screen.ATTR_RED_FG),
+                         tuple(int(array[2, 6]) for array in arrays))
+        self.assertEqual(1, numpy.count_nonzero(arrays.chars))
+        self.assertEqual(1, numpy.count_nonzero(arrays.tile_nums != screen.EMPTY_TILE))
+
+        self.screen.cursor_x = 80
+        self.screen.cursor_y = 24
+        self.screen.set_char(ord(b'#'))
+        self.assertEqual(ord(b'#'), arrays.chars[23, 79])
+
+    def test_copy(self):
+        """Copies don't change with the window, and windows without tiles have none."""
+        arrays = observe.map_arrays(self.screen, copy=True)
+        self.assertTrue(arrays.chars.flags.writeable)
+        self.screen.clear_rows(1, screen.ROWS)
+        self.assertEqual(ord(b'@'), arrays.chars[2, 6])
+        self.assertEqual(0, numpy.count_nonzero(observe.map_arrays(self.screen).chars))
+
+        base = observe.window_arrays(self.screen.windows[screen.BASE_WINDOW])
+        self.assertTrue((base.tile_nums == screen.EMPTY_TILE).all())
+        self.assertTrue((base.tile_flags == screen.EMPTY_TILE).all())
+
+    def test_fill_batch(self):
+        """Parsers and screens are copied into their slot of the batch."""
+        parser_ = parser.Parser()
+        parser_.parse_bytes(b'\x1b[1;2;3z\x1b[1;0;77;1z%\x1b[1;1z')
+        batch = observe.new_batch(3)
+        self.assertEqual(2, observe.fill_batch(batch, [self.screen, parser_]))
+        self.assertEqual((ord(b'@'), 1234, 2, 1 << screen.ATTR_RED_FG),
+                         tuple(int(array[0, 2, 6]) for array in batch))
+        self.assertEqual((ord(b'%'), 77, 1, 0),
+                         tuple(int(array[1, 0, 0]) for array in batch))
+        self.assertEqual(0, numpy.count_nonzero(batch.chars[2]))
+
+        # reusing the batch overwrites the earlier contents
+        self.assertEqual(1, observe.fill_batch(batch, iter([parser_.screen]),
+                                               window=screen.BASE_WINDOW))
+        self.assertEqual(0, numpy.count_nonzero(batch.chars[0]))
+        self.assertTrue((batch.tile_nums[0] == screen.EMPTY_TILE).all())
+        with self.assertRaises(ValueError):
+            observe.fill_batch(batch, [self.screen] * 4)
+
+if __name__ == '__main__':
+    unittest.main()
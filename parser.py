@@ -1,7 +1,9 @@
 """This parser can read data from a nethack proces (server) and
    convert it into the screendata model."""
 
+import functools
 import itertools
+import re
 
 import screen
 
@@ -15,19 +17,196 @@ TILE_STATE_END = 1
 TILE_STATE_START = 2
 TILE_STATE_MID = 3
 
-class Parser:
+# Most arguments any escape sequence handler can ask for
+MAX_ESCAPE_ARGS = 16
+# How many distinct escape sequences to remember the arguments of
+ESCAPE_ARGS_CACHE_SIZE = 1024
+
+# A run of printable bytes, anything except ESC and the other control bytes
+PRINTABLE_RUN_RE = re.compile(rb'[^\x00-\x1f]+')
+
+# Longest escape sequence the parser accepts, not counting the ESC
+MAX_ESCAPE_LENGTH = 64
+
+# Tokens for the tokenizer mode of Parser, any of: a run of printable bytes
+# (group 1), a complete CSI escape (group 2 is the sequence after the ESC and
+# group 3 the final byte), two ESCs in a row or a single control byte. CSI
+# escapes longer than MAX_ESCAPE_LENGTH don't match, so they are left to the
+# state machine to reject.
+TOKEN_RE = re.compile(rb'([^\x00-\x1f]+)|\x1b(\[[\x20-\x3f]{0,%d})([\x40-\x7e])|'
+                      rb'\x1b\x1b|[\x00-\x1f]' % (MAX_ESCAPE_LENGTH - 1))
+# An escape cut off by the end of the chunk, which can still be completed
+# within MAX_ESCAPE_LENGTH
+PARTIAL_ESCAPE_RE = re.compile(rb'\x1b(?:\[[\x20-\x3f]{0,%d})?\Z' % (MAX_ESCAPE_LENGTH - 1))
+
+# Byte classes for the parser state machine. What a class means depends on
+# the state, e.g. outside an escape every class from CLASS_PARAMETER on is
+# just a printable character.
+CLASS_CONTROL = 0 # control bytes with no effect
+CLASS_BACKSPACE = 1
+CLASS_LINE_FEED = 2
+CLASS_CARRIAGE_RETURN = 3
+CLASS_ESCAPE = 4
+CLASS_PARAMETER = 5 # 0x20-0x3f, escape parameter (and intermediate) bytes
+CLASS_CSI = 6 # '[', starts a CSI escape, otherwise a final byte
+CLASS_FINAL = 7 # the other 0x40-0x7e final bytes
+CLASS_HIGH = 8 # 0x7f-0xff, never part of an escape
+NUM_CLASSES = 9
+
+def _byte_class(byte):
+    """Internal function: the class of a byte, for building BYTE_CLASSES"""
+    special = {8: CLASS_BACKSPACE, 10: CLASS_LINE_FEED, 13: CLASS_CARRIAGE_RETURN,
+               27: CLASS_ESCAPE, ord(b'['): CLASS_CSI}
+    if byte in special:
+        return special[byte]
+    if byte < 0x20:
+        return CLASS_CONTROL
+    if byte <= 0x3f:
+        return CLASS_PARAMETER
+    if byte <= 0x7e:
+        return CLASS_FINAL
+    return CLASS_HIGH
+
+# The class of each byte value
+BYTE_CLASSES = bytes(_byte_class(byte) for byte in range(256))
+
+# Parser states
+STATE_GROUND = 0 # not in an escape
+STATE_ESCAPE = 1 # just after an ESC
+STATE_CSI = 2 # in the parameters of a CSI escape
+NUM_STATES = 3
+
+# SGR codes in SGR_TABLE, codes past these are ignored
+NUM_SGR_CODES = 108
+# The bright colors of 16 color terminals, 90-97 for the foreground and
+# 100-107 for the background, are this far above the normal colors
+SGR_BRIGHT_OFFSET = 60
+
+def _sgr_masks(num): # pylint: disable=too-many-return-statements
+    """Internal function: the (clear_mask, set_mask) of an SGR code, for building
+       SGR_TABLE. Processing the options is surprisingly complicated. It's
+       unlikely that this is really 100% correct for full vt100 terminal
+       emulation, but it is at least good enough to parse nethack."""
+    # NORMAL == no attributes
+    if num == screen.ATTR_NORMAL:
+        return (-1, 0)
+
+    # Bright colors are the normal color, bright foregrounds are shown as bold
+    if (screen.ATTR_BLACK_FG + SGR_BRIGHT_OFFSET <= num <=
+            screen.ATTR_WHITE_FG + SGR_BRIGHT_OFFSET):
+        (clear, set_) = _sgr_masks(num - SGR_BRIGHT_OFFSET)
+        return (clear | screen.ATTR_INTENSITY_BITMASK, set_ | 1 << screen.ATTR_BOLD)
+    if (screen.ATTR_BLACK_BG + SGR_BRIGHT_OFFSET <= num <=
+            screen.ATTR_WHITE_BG + SGR_BRIGHT_OFFSET):
+        return _sgr_masks(num - SGR_BRIGHT_OFFSET)
+
+    # Anything else that doesn't fit the attribute bitmap is ignored
+    if num >= screen.MAX_ATTRIBUTES:
+        return (0, 0)
+
+    # Some attributes are mutually exclusive
+    for mask in (screen.ATTR_INTENSITY_BITMASK, screen.ATTR_BLINK_BITMASK,
+                 screen.ATTR_FONT_BITMASK, screen.ATTR_FG_BITMASK, screen.ATTR_BG_BITMASK):
+        if mask & (1 << num):
+            if num in (screen.ATTR_DEFAULT_FONT, screen.ATTR_DEFAULT_FG, screen.ATTR_DEFAULT_BG):
+                return (mask, 0)
+            return (mask, 1 << num)
+
+    # Some attributes actually negate other attributes
+    negative_attrs = {screen.ATTR_NORMAL_INTENSITY: screen.ATTR_INTENSITY_BITMASK,
+                      screen.ATTR_NOT_ITALIC: 1<<screen.ATTR_ITALIC,
+                      screen.ATTR_NOT_UNDERLINE: screen.ATTR_UNDERLINE_BITMASK,
+                      screen.ATTR_BLINK_OFF: screen.ATTR_BLINK_BITMASK,
+                      screen.ATTR_INVERSE_OFF: 1<<screen.ATTR_INVERSE,
+                      screen.ATTR_CONCEAL_OFF: 1<<screen.ATTR_CONCEAL,
+                      screen.ATTR_STRIKE_OFF: 1<<screen.ATTR_STRIKE}
+    if num in negative_attrs:
+        return (negative_attrs[num], 0)
+
+    # This attribute also clears bold in addition to setting the attr, for whatever reason
+    if num == screen.ATTR_2X_UNDERLINE:
+        return (1 << screen.ATTR_BOLD, 1 << num)
+
+    # simple bitmask set is the default
+    return (0, 1 << num)
+
+# (clear_mask, set_mask) for each SGR code, applying the code to a bitmap
+# is bitmap = (bitmap & ~clear_mask) | set_mask
+SGR_TABLE = tuple(_sgr_masks(num) for num in range(NUM_SGR_CODES))
+
+@functools.lru_cache(maxsize=ESCAPE_ARGS_CACHE_SIZE)
+def sgr_masks(args):
+    """Fold the arguments of an SGR escape (a tuple of codes) into a single
+       (clear_mask, set_mask) with the same effect as applying each code in
+       turn. The set color codes are followed by 5;n or 2;r;g;b, the color
+       itself is ignored for now and just the custom color flag is set.
+       Unknown codes are ignored. Nethack repeats the same escapes constantly,
+       so results are cached."""
+    clear = 0
+    set_ = 0
+    pos = 0
+    while pos < len(args):
+        num = args[pos]
+        pos += 1
+        if num in (screen.ATTR_SET_COLOR_FG, screen.ATTR_SET_COLOR_BG):
+            color_args = {5: 1, 2: 3}.get(args[pos] if pos < len(args) else None)
+            if color_args is None or pos + color_args >= len(args):
+                raise ParseException("Incorrect number of arguments to set color")
+            pos += 1 + color_args
+        (num_clear, num_set) = SGR_TABLE[num] if num < NUM_SGR_CODES else (0, 0)
+        # applying (clear, set_) then (num_clear, num_set) is the same as
+        # applying this combination
+        clear |= num_clear
+        set_ = (set_ & ~num_clear) | num_set
+    return (clear, set_)
+
+# Defaults for an SGR escape with n arguments are SGR_DEFAULTS[n], missing
+# arguments are 0
+SGR_DEFAULTS = tuple((0,) * num for num in range(MAX_ESCAPE_ARGS + 1))
+
+class Parser: # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """Class representing the parser."""
 
-    def __init__(self):
+    def __init__(self, tokenize=False, record_events=True):
         """Initialize the parser. Starts with empty screendata.
-           escape_sequence = None mean no escape syntax in progress
-           Otherwise the escape_sequence is a bytearray that contains
-           the sequence so far.
+           state is one of the STATE_* constants, outside STATE_GROUND the
+           first escape_length bytes of escape_buffer are the sequence so far.
+           The buffer is allocated once and reused for every escape.
+           tokenize - if True parse_bytes splits each chunk into tokens with
+           TOKEN_RE rather than running the state machine on each byte of the
+           escapes, see parse_tokens.
+           record_events - passed on to the ScreenData, if False no frames of
+           change events are kept.
         """
-        self.screen = screen.ScreenData()
-        self.escape_sequence = None
+        self.screen = screen.ScreenData(record_events=record_events)
+        self.tokenize = tokenize
+        # the start of an escape cut off at the end of the last chunk, in tokenize mode
+        self.carry = b''
+        self.state = STATE_GROUND
+        self.escape_buffer = bytearray(MAX_ESCAPE_LENGTH)
+        self.escape_length = 0
+        # slicing a view of the buffer doesn't copy, so a finished escape is
+        # only copied once, into the bytes handed to its handler
+        self._escape_view = memoryview(self.escape_buffer)
         self.end_of_data = True
+        # set once any vt_tiledata escape has been parsed
+        self.seen_tiledata = False
         self.tile_state = TILE_STATE_END
+        self._escape_args = [None] * MAX_ESCAPE_ARGS
+        self._escape_args_cache = functools.lru_cache(
+            maxsize=ESCAPE_ARGS_CACHE_SIZE)(self._scan_escape_args)
+        # bind the class handler table to this parser once, so dispatching an
+        # escape is a single dict lookup. Looking the methods up by name means
+        # subclasses can override them.
+        self.csi_handlers = {final_byte: getattr(self, name)
+                             for (final_byte, name) in self.CSI_HANDLERS.items()}
+        # likewise combine BYTE_CLASSES and TRANSITIONS into a table of
+        # (bound action, next state) indexed by state then byte
+        actions = {name: getattr(self, name) for row in self.TRANSITIONS for (name, _) in row}
+        self.transitions = tuple(
+            tuple((actions[self.TRANSITIONS[state][byte_class][0]],
+                   self.TRANSITIONS[state][byte_class][1]) for byte_class in BYTE_CLASSES)
+            for state in range(NUM_STATES))
 
     @staticmethod
     def is_parameter_byte(byte):
@@ -42,271 +221,420 @@ class Parser:
         return 0x40 <= byte <= 0x7e
 
     def parse_bytes(self, bytes_):
-        """Convenience. Loop over the bytes and call parseByte on each one"""
-        for byte in bytes_:
-            self.parse_byte(byte)
+        """Parse a chunk of input. Runs of two or more printable bytes outside
+           of escape sequences are handed to the screen in bulk, anything else
+           goes through the state machine one byte at a time. Single printable
+           bytes are common (e.g. after cursor moves), so the regex is only
+           tried once the next byte is printable too."""
+        if self.tokenize:
+            self.parse_tokens(bytes_)
+            return
+        transitions = self.transitions
+        byte_classes = BYTE_CLASSES
+        pos = 0
+        end = len(bytes_)
+        # the actions don't look at the state, so it is only kept in self.state
+        # between chunks (or when an action raises)
+        state = self.state
+        try:
+            while pos < end:
+                byte = bytes_[pos]
+                if (state == STATE_GROUND and byte_classes[byte] >= CLASS_PARAMETER and
+                        pos + 1 < end and byte_classes[bytes_[pos + 1]] >= CLASS_PARAMETER and
+                        self._can_write_run()):
+                    run_end = PRINTABLE_RUN_RE.match(bytes_, pos).end()
+                    self.end_of_data = False
+                    self.screen.write_run(bytes_[pos:run_end], clear_tiles=(
+                        self.screen.current_window == screen.MAP_WINDOW))
+                    pos = run_end
+                    continue
+                # parse_byte inlined
+                self.end_of_data = False
+                (action, state) = transitions[state][byte]
+                action(byte)
+                pos += 1
+        finally:
+            self.state = state
 
-    def parse_byte(self, byte): # pylint: disable=too-many-branches
-        """Parse the input stream byte-by-byte."""
-        self.end_of_data = False
-        if byte == 27:
-            if self.escape_sequence is None:
-                self.escape_sequence = bytearray()
-            elif self.escape_sequence == b'':
-                # Two escapes in a row is "nothing"
-                self.escape_sequence = None
-            else:
-                # Illegal escape syntax, got another escape before final byte
-                raise ParseException("Illegal escape syntax")
-        elif self.escape_sequence is not None:
-            if not self.escape_sequence:
-                if byte != ord(b'['):
-                    # We can only handle CSI sequences
-                    raise ParseException("Illegal escape prefix")
-                self.escape_sequence.append(byte)
-            elif self.is_final_byte(byte):
-                self.handle_escape_sequence(byte, self.escape_sequence)
-                self.escape_sequence = None
-            elif not self.is_parameter_byte(byte):
-                # Illegal escape syntax, not valid byte for an escape syntax
-                raise ParseException("Illegal escape syntax")
-            else:
-                self.escape_sequence.append(byte)
-        else:
-            # Non-escape sequence character, check for screen movement chars
-            if byte == 8:
-                # Backspace
-                self.screen.cursor_x -= 1
-                self.screen.clamp_cursor()
-            elif byte == 10:
-                # Line feed
-                self.screen.cursor_y += 1
-                self.screen.clamp_cursor()
-            elif byte == 13:
-                # Carrige return
-                self.screen.cursor_x = 1
-            elif byte < 32:
-                # Ignore other control characters
-                pass
+    def parse_tokens(self, bytes_): # pylint: disable=too-many-branches
+        """Parse a chunk of input a token at a time, see TOKEN_RE. The regex
+           finds whole escapes so the Python work is per token rather than per
+           byte. An escape cut off at the end of the chunk is carried over to
+           the next one. Anything TOKEN_RE doesn't match is illegal, it is
+           handed to the state machine to raise the right ParseException."""
+        if self.carry:
+            bytes_ = self.carry + bytes(bytes_)
+            self.carry = b''
+        screen_ = self.screen
+        ground = self.transitions[STATE_GROUND]
+        for match in TOKEN_RE.finditer(bytes_):
+            self.end_of_data = False
+            (run, seq, final) = match.groups()
+            if run is not None:
+                if len(run) == 1:
+                    self._print(run[0])
+                elif self._can_write_run():
+                    screen_.write_run(run, clear_tiles=screen_.current_window == screen.MAP_WINDOW)
+                else:
+                    # only the one char allowed in the tile, _print raises on the next
+                    for byte in run:
+                        self._print(byte)
+            elif seq is not None:
+                self.handle_escape_sequence(final[0], seq)
             else:
-                # handle clearing tiledata state-machine
-                if self.screen.current_window == screen.MAP_WINDOW:
-                    if self.tile_state == TILE_STATE_END:
-                        # Writing data outside a tile escape clears the tiledata
-                        self.screen.get_current_data().clear_tile()
-                    elif self.tile_state == TILE_STATE_START:
-                        # a single char is allowed per tile
-                        self.tile_state = TILE_STATE_MID
-                    elif self.tile_state == TILE_STATE_MID:
-                        # got a second char in the tile
-                        raise ParseException('Multiple characters in tile')
-                self.screen.set_char(byte)
+                start = match.start()
+                byte = bytes_[start]
+                if byte != 27:
+                    ground[byte][0](byte)
+                elif match.end() - start == 1:
+                    if PARTIAL_ESCAPE_RE.match(bytes_, start):
+                        self.carry = bytes(bytes_[start:])
+                    else:
+                        for byte in bytes_[start:]:
+                            self.parse_byte(byte)
+                    return
+                # else two ESCs in a row is nothing
 
-    @staticmethod
-    def parse_escape_args(seq, defaults):
+    def _can_write_run(self):
+        """Internal function: True if a run of printable bytes can be written in bulk.
+           Only a single character is allowed inside a tile escape, so that case
+           has to go through the tiledata state machine in parse_byte."""
+        return (self.screen.current_window != screen.MAP_WINDOW or
+                self.tile_state == TILE_STATE_END)
+
+    def parse_byte(self, byte):
+        """Parse the input stream byte-by-byte. The byte's class and the current
+           state pick the action and the next state from the transitions table."""
+        self.end_of_data = False
+        (action, self.state) = self.transitions[self.state][byte]
+        action(byte)
+
+    def end_frame(self):
+        """Without tiledata nethack never sends the end-of-data escape, so the
+           caller has to decide when a frame is over (e.g. after a timeout) and
+           call this to end it the same way. Otherwise the screen's pending
+           events would grow forever. Does nothing if the frame already ended."""
+        if not self.end_of_data:
+            self.end_of_data = True
+            self.screen.end_frame()
+
+    def _print(self, byte):
+        """Internal action: a printable character outside of an escape"""
+        # handle clearing tiledata state-machine
+        if self.screen.current_window == screen.MAP_WINDOW:
+            if self.tile_state == TILE_STATE_END:
+                # Writing data outside a tile escape clears the tiledata
+                self.screen.clear_tile()
+            elif self.tile_state == TILE_STATE_START:
+                # a single char is allowed per tile
+                self.tile_state = TILE_STATE_MID
+            elif self.tile_state == TILE_STATE_MID:
+                # got a second char in the tile
+                raise ParseException('Multiple characters in tile')
+        self.screen.set_char(byte)
+
+    def _ignore(self, byte): # pylint: disable=unused-argument
+        """Internal action: ignore other control characters"""
+
+    def _backspace(self, byte): # pylint: disable=unused-argument
+        """Internal action: backspace"""
+        self.screen.cursor_x -= 1
+        self.screen.clamp_cursor()
+
+    def _line_feed(self, byte): # pylint: disable=unused-argument
+        """Internal action: line feed"""
+        self.screen.cursor_y += 1
+        self.screen.clamp_cursor()
+
+    def _carriage_return(self, byte): # pylint: disable=unused-argument
+        """Internal action: carriage return"""
+        self.screen.cursor_x = 1
+
+    def _start_escape(self, byte): # pylint: disable=unused-argument
+        """Internal action: ESC starts an escape sequence"""
+        self.escape_length = 0
+
+    def _cancel_escape(self, byte): # pylint: disable=unused-argument
+        """Internal action: two escapes in a row is nothing"""
+        self.escape_length = 0
+
+    def _collect_escape(self, byte):
+        """Internal action: add a byte to the escape sequence"""
+        length = self.escape_length
+        if length == MAX_ESCAPE_LENGTH:
+            raise ParseException("Escape sequence too long")
+        self.escape_buffer[length] = byte
+        self.escape_length = length + 1
+
+    def _dispatch_escape(self, byte):
+        """Internal action: a final byte ends the escape sequence"""
+        self.handle_escape_sequence(byte, bytes(self._escape_view[:self.escape_length]))
+        self.escape_length = 0
+
+    def _illegal_prefix(self, byte): # pylint: disable=unused-argument
+        """Internal action: we can only handle CSI sequences"""
+        raise ParseException("Illegal escape prefix")
+
+    def _illegal_syntax(self, byte): # pylint: disable=unused-argument
+        """Internal action: not a valid byte for an escape syntax"""
+        raise ParseException("Illegal escape syntax")
+
+    def parse_escape_args(self, seq, defaults):
         """Parse the argument bits of the escape sequence,
            integers separated by semicolons. Any missing
-           arguments will be filled in from defaults."""
-        if len(seq) == 1:
-            splt = ()
-        else:
-            splt = seq[1:].split(b';')
-        if len(splt) > len(defaults):
+           arguments will be filled in from defaults. Returns
+           a tuple with one entry per default. Nethack repeats
+           the same sequences constantly, so results are cached."""
+        return self._escape_args_cache(bytes(seq), defaults)
+
+    def _scan_escape_args(self, seq, defaults): # pylint: disable=too-many-branches
+        """Internal function: uncached version of parse_escape_args. Makes a single
+           pass over seq, collecting the arguments in a preallocated array."""
+        num_defaults = len(defaults)
+        if num_defaults > MAX_ESCAPE_ARGS:
             raise ParseException("Too many escape sequence arguments")
-        for tok, dflt in itertools.zip_longest(splt, defaults):
-            tok = b"" if tok is None else tok.strip()
-            if not tok:
-                yield dflt
+        args = self._escape_args
+        count = 0
+        num = None
+        num_done = False # seen whitespace after the digits of num
+        for byte in itertools.islice(seq, 1, None):
+            if 0x30 <= byte <= 0x39:
+                if num_done:
+                    raise ParseException("Non-numeric escape sequence argument: "+str(seq))
+                num = byte - 0x30 if num is None else num*10 + byte - 0x30
+            elif byte == 0x3b:
+                # semicolon ends an argument, and there is always one more after it
+                if count + 2 > num_defaults:
+                    raise ParseException("Too many escape sequence arguments")
+                args[count] = defaults[count] if num is None else num
+                count += 1
+                num = None
+                num_done = False
+            elif byte == 0x20:
+                num_done = num is not None
             else:
-                try:
-                    num = int(tok, 10)
-                    if num < 0:
-                        raise ParseException("Escape sequence argument must be positive")
-                    yield num
-                except ValueError:
-                    raise ParseException("Non-numeric escape sequence argument: "+str(tok))
-
-    def handle_sgr_attribute(self, num):
-        """The SGR escape controls the look of the characters, and the processing
-           of the options is surprisingly complicated. It's unlikely that this is
-           really 100% correct for full vt100 terminal emulation, but it is at
-           least good enough to parse nethack."""
-        # NORMAL == no attributes
-        if num == screen.ATTR_NORMAL:
-            self.screen.current_attributes.clear_all()
-            return
+                raise ParseException("Non-numeric escape sequence argument: "+str(seq))
+        if len(seq) > 1:
+            if count + 1 > num_defaults:
+                raise ParseException("Too many escape sequence arguments")
+            args[count] = defaults[count] if num is None else num
+            count += 1
+        for i in range(count, num_defaults):
+            args[i] = defaults[i]
+        return tuple(itertools.islice(args, num_defaults))
 
-        # Some attributes are mutually exclusive
-        exclusive_bitmasks = (screen.ATTR_INTENSITY_BITMASK, screen.ATTR_BLINK_BITMASK,
-                              screen.ATTR_FONT_BITMASK, screen.ATTR_FG_BITMASK,
-                              screen.ATTR_BG_BITMASK)
-        for mask in exclusive_bitmasks:
-            if mask & (1 << num):
-                self.screen.current_attributes.clear_mask(mask)
-                if num not in (screen.ATTR_DEFAULT_FONT, screen.ATTR_DEFAULT_FG,
-                               screen.ATTR_DEFAULT_BG):
-                    self.screen.current_attributes.set(num)
-                return
-
-        # Some attributes actually negate other attributes
-        negative_attrs = ((screen.ATTR_NORMAL_INTENSITY, screen.ATTR_INTENSITY_BITMASK),
-                          (screen.ATTR_NOT_ITALIC, 1<<screen.ATTR_ITALIC),
-                          (screen.ATTR_NOT_UNDERLINE, screen.ATTR_UNDERLINE_BITMASK),
-                          (screen.ATTR_BLINK_OFF, screen.ATTR_BLINK_BITMASK),
-                          (screen.ATTR_INVERSE_OFF, 1<<screen.ATTR_INVERSE),
-                          (screen.ATTR_CONCEAL_OFF, 1<<screen.ATTR_CONCEAL),
-                          (screen.ATTR_STRIKE_OFF, 1<<screen.ATTR_STRIKE))
-        for attr, mask in negative_attrs:
-            if num == attr:
-                self.screen.current_attributes.clear_mask(mask)
-                return
-
-        # This attribute also clears bold in addition to setting the attr, for whatever reason
-        if num == screen.ATTR_2X_UNDERLINE:
-            self.screen.current_attributes.clear(screen.ATTR_BOLD)
-
-        # simple bitmask set is the default
-        self.screen.current_attributes.set(num)
-
-    def handle_escape_sequence(self, final_byte, seq): # pylint: disable=too-many-branches,too-many-statements,too-many-locals
+    def handle_escape_sequence(self, final_byte, seq):
         """Handle the given escape syntax. Don't include actual escape (27) character
            and pass the final byte only in the separate argument."""
-        if seq[0] == ord(b'['):
-            if final_byte == ord(b'A'):
-                # Cursor Up
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_y -= num
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'B'):
-                # Cursor Down
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_y += num
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'C'):
-                # Cursor Forward
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_x += num
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'D'):
-                # Cursor Back
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_x -= num
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'E'):
-                # Cursor Next Line
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_y += num
-                self.screen.cursor_x = 1
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'F'):
-                # Cursor Previous Line
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_y -= num
-                self.screen.cursor_x = 1
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'G'):
-                # Cursor Horizontal Absolute
-                (num,) = self.parse_escape_args(seq, (1,))
-                self.screen.cursor_x = num
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'H') or final_byte == ord(b'f'):
-                # Cursor Position
-                # y is first!
-                (y, x) = self.parse_escape_args(seq, (1, 1))
-                self.screen.cursor_x = x
-                self.screen.cursor_y = y
-                self.screen.clamp_cursor()
-            elif final_byte == ord(b'J'):
-                # Erase in Display
-                (num,) = self.parse_escape_args(seq, (0,))
-                if num == 0:
-                    start_y = self.screen.cursor_y
-                    end_y = screen.ROWS
-                elif num == 1:
-                    start_y = 1
-                    end_y = self.screen.cursor_y
-                elif num in (2, 3):
-                    start_y = 1
-                    end_y = screen.ROWS
-                else:
-                    raise ParseException("Illegal escape erase display code")
-                self.screen.clear_rows(start_y, end_y, all_windows=True)
-            elif final_byte == ord(b'K'):
-                # Erase in Line
-                (num,) = self.parse_escape_args(seq, (0,))
-                if num == 0:
-                    start_x = self.screen.cursor_x
-                    end_x = screen.COLUMNS
-                elif num == 1:
-                    start_x = 1
-                    end_x = self.screen.cursor_x
-                elif num == 2:
-                    start_x = 1
-                    end_x = screen.COLUMNS
-                else:
-                    raise ParseException('Illegal escape erase line code')
-                self.screen.clear_cols(start_x, end_x, self.screen.cursor_y, all_windows=True)
-            elif final_byte in (ord(b'h'), ord(b'l'), ord(b't')):
-                # ignore some 'private' sequences
-                pass
-            elif final_byte == ord(b'm'):
-                # Select Graphic Rendition
-                extra_args = [None, None, None, None]
-                (num, extra_args[0], extra_args[1], extra_args[2], extra_args[3]) = \
-                    self.parse_escape_args(seq, (0, None, None, None, None))
-                # Annoyingly the "custom color" SGR can take arguments. The arguments are ignored
-                # for now and just the custom color flag is set without the rgb value, etc.
-                # Nethack doesn't seem to use these anyway. Just verify that no other SGR codes
-                # got unexpected arguments.
-                num_extra_args = 0
-                for i in range(4):
-                    if extra_args[i] is not None:
-                        num_extra_args += 1
-                if num in (screen.ATTR_SET_COLOR_FG, screen.ATTR_SET_COLOR_BG):
-                    if num_extra_args not in (2, 4):
-                        raise ParseException("Incorrect number of arguments to set color")
-                else:
-                    if num_extra_args != 0:
-                        raise ParseException("Unexpected argument to SGR escape")
-                self.handle_sgr_attribute(num)
-            elif final_byte == ord(b'z'):
-                # nethack vt_tiledata escape
-                (version, td_code, num1, num2) = self.parse_escape_args(seq,
-                                                                        (None, None, None, None))
-                if version != 1:
-                    raise ParseException('Wrong version of vt_tiledata escape')
-                if td_code == 0:
-                    # Start Glyph
-                    if self.tile_state != TILE_STATE_END:
-                        raise ParseException('Nested tiledata escapes')
-                    if self.screen.current_window != screen.MAP_WINDOW:
-                        raise ParseException('Tiledata outside of map window')
-                    self.tile_state = TILE_STATE_START
-                    self.screen.set_tile(num1, num2)
-                elif td_code == 1:
-                    # End Glyph
-                    if not (num1 is None and num2 is None):
-                        raise ParseException('Unexpected argument to end glyph')
-                    if self.tile_state != TILE_STATE_MID:
-                        raise ParseException('Unexpected end glyph context')
-                    self.tile_state = TILE_STATE_END
-                elif td_code == 2:
-                    # Switch Window
-                    if num2 is not None:
-                        raise ParseException('Too many arguments to switch window')
-                    if self.tile_state != TILE_STATE_END:
-                        raise ParseException('Switch window during tiledata')
-                    self.screen.current_window = num1
-                elif td_code == 3:
-                    # End of Data
-                    if not (num1 is None and num2 is None):
-                        raise ParseException('Unexpected argument to end-of-data')
-                    if self.tile_state != TILE_STATE_END:
-                        raise ParseException('End-of-date during tiledata')
-                    self.end_of_data = True
-                else:
-                    raise ParseException('Unrecognized vt_tiledata escape code')
-            else:
-                raise ParseException('Illegal escape code suffix')
-        else:
+        if seq[0] != ord(b'['):
             raise ParseException("Unrecognized escape syntax prefix")
+        handler = self.csi_handlers.get(final_byte)
+        if handler is None:
+            raise ParseException('Illegal escape code suffix')
+        handler(seq)
+
+    def add_csi_handler(self, final_byte, handler):
+        """Register a handler for CSI escapes ending in final_byte with this parser,
+           replacing any existing handler. The handler is called with the escape
+           sequence (starting with the '[') and can use parse_escape_args to get
+           at the arguments. To extend every parser instead, subclass and
+           override the handle_* methods, or give the subclass its own
+           CSI_HANDLERS such as {**Parser.CSI_HANDLERS, final_byte: 'method_name'}.
+           Don't change Parser.CSI_HANDLERS itself, every parser shares it."""
+        if not self.is_final_byte(final_byte):
+            raise ValueError('Not a valid escape final byte: '+str(final_byte))
+        self.csi_handlers[final_byte] = handler
+
+    def handle_cursor_up(self, seq):
+        """Cursor Up"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_y -= num
+        self.screen.clamp_cursor()
+
+    def handle_cursor_down(self, seq):
+        """Cursor Down"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_y += num
+        self.screen.clamp_cursor()
+
+    def handle_cursor_forward(self, seq):
+        """Cursor Forward"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_x += num
+        self.screen.clamp_cursor()
+
+    def handle_cursor_back(self, seq):
+        """Cursor Back"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_x -= num
+        self.screen.clamp_cursor()
+
+    def handle_cursor_next_line(self, seq):
+        """Cursor Next Line"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_y += num
+        self.screen.cursor_x = 1
+        self.screen.clamp_cursor()
+
+    def handle_cursor_previous_line(self, seq):
+        """Cursor Previous Line"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_y -= num
+        self.screen.cursor_x = 1
+        self.screen.clamp_cursor()
+
+    def handle_cursor_horizontal_absolute(self, seq):
+        """Cursor Horizontal Absolute"""
+        (num,) = self.parse_escape_args(seq, (1,))
+        self.screen.cursor_x = num
+        self.screen.clamp_cursor()
+
+    def handle_cursor_position(self, seq):
+        """Cursor Position"""
+        # y is first!
+        (y, x) = self.parse_escape_args(seq, (1, 1))
+        self.screen.cursor_x = x
+        self.screen.cursor_y = y
+        self.screen.clamp_cursor()
+
+    def handle_erase_display(self, seq):
+        """Erase in Display"""
+        (num,) = self.parse_escape_args(seq, (0,))
+        if num == 0:
+            start_y = self.screen.cursor_y
+            end_y = screen.ROWS
+        elif num == 1:
+            start_y = 1
+            end_y = self.screen.cursor_y
+        elif num in (2, 3):
+            start_y = 1
+            end_y = screen.ROWS
+        else:
+            raise ParseException("Illegal escape erase display code")
+        self.screen.clear_rows(start_y, end_y, all_windows=True)
+
+    def handle_erase_line(self, seq):
+        """Erase in Line"""
+        (num,) = self.parse_escape_args(seq, (0,))
+        if num == 0:
+            start_x = self.screen.cursor_x
+            end_x = screen.COLUMNS
+        elif num == 1:
+            start_x = 1
+            end_x = self.screen.cursor_x
+        elif num == 2:
+            start_x = 1
+            end_x = screen.COLUMNS
+        else:
+            raise ParseException('Illegal escape erase line code')
+        self.screen.clear_cols(start_x, end_x, self.screen.cursor_y, all_windows=True)
+
+    def handle_ignored(self, seq): # pylint: disable=unused-argument
+        """Ignore some 'private' sequences"""
+
+    def handle_sgr(self, seq):
+        """Select Graphic Rendition. Any number of codes can be given, they are
+           folded into one change to the attributes by sgr_masks."""
+        num_args = seq.count(b';') + 1
+        if num_args > MAX_ESCAPE_ARGS:
+            raise ParseException("Too many escape sequence arguments")
+        (clear, set_) = sgr_masks(self.parse_escape_args(seq, SGR_DEFAULTS[num_args]))
+        attributes = self.screen.current_attributes
+        attributes.bitmap = (attributes.bitmap & ~clear) | set_
+
+    def handle_tiledata(self, seq): # pylint: disable=too-many-branches
+        """nethack vt_tiledata escape"""
+        (version, td_code, num1, num2) = self.parse_escape_args(seq,
+                                                                (None, None, None, None))
+        if version != 1:
+            raise ParseException('Wrong version of vt_tiledata escape')
+        self.seen_tiledata = True
+        if td_code == 0:
+            # Start Glyph
+            if self.tile_state != TILE_STATE_END:
+                raise ParseException('Nested tiledata escapes')
+            if self.screen.current_window != screen.MAP_WINDOW:
+                raise ParseException('Tiledata outside of map window')
+            if max(num1 or 0, num2 or 0) > screen.MAX_TILE_VALUE:
+                raise ParseException('Tile number or flag too large')
+            self.tile_state = TILE_STATE_START
+            self.screen.set_tile(num1, num2)
+        elif td_code == 1:
+            # End Glyph
+            if not (num1 is None and num2 is None):
+                raise ParseException('Unexpected argument to end glyph')
+            if self.tile_state != TILE_STATE_MID:
+                raise ParseException('Unexpected end glyph context')
+            self.tile_state = TILE_STATE_END
+        elif td_code == 2:
+            # Switch Window
+            if num2 is not None:
+                raise ParseException('Too many arguments to switch window')
+            if self.tile_state != TILE_STATE_END:
+                raise ParseException('Switch window during tiledata')
+            self.screen.switch_window(num1)
+        elif td_code == 3:
+            # End of Data
+            if not (num1 is None and num2 is None):
+                raise ParseException('Unexpected argument to end-of-data')
+            if self.tile_state != TILE_STATE_END:
+                raise ParseException('End-of-date during tiledata')
+            self.end_of_data = True
+            self.screen.end_frame()
+        else:
+            raise ParseException('Unrecognized vt_tiledata escape code')
+
+    # (action method name, next state) for each state and byte class. The next
+    # state is irrelevant for actions that raise.
+    TRANSITIONS = (
+        # STATE_GROUND
+        (('_ignore', STATE_GROUND), # CLASS_CONTROL
+         ('_backspace', STATE_GROUND), # CLASS_BACKSPACE
+         ('_line_feed', STATE_GROUND), # CLASS_LINE_FEED
+         ('_carriage_return', STATE_GROUND), # CLASS_CARRIAGE_RETURN
+         ('_start_escape', STATE_ESCAPE), # CLASS_ESCAPE
+         ('_print', STATE_GROUND), # CLASS_PARAMETER
+         ('_print', STATE_GROUND), # CLASS_CSI
+         ('_print', STATE_GROUND), # CLASS_FINAL
+         ('_print', STATE_GROUND)), # CLASS_HIGH
+        # STATE_ESCAPE
+        (('_illegal_prefix', STATE_GROUND), # CLASS_CONTROL
+         ('_illegal_prefix', STATE_GROUND), # CLASS_BACKSPACE
+         ('_illegal_prefix', STATE_GROUND), # CLASS_LINE_FEED
+         ('_illegal_prefix', STATE_GROUND), # CLASS_CARRIAGE_RETURN
+         ('_cancel_escape', STATE_GROUND), # CLASS_ESCAPE
+         ('_illegal_prefix', STATE_GROUND), # CLASS_PARAMETER
+         ('_collect_escape', STATE_CSI), # CLASS_CSI
+         ('_illegal_prefix', STATE_GROUND), # CLASS_FINAL
+         ('_illegal_prefix', STATE_GROUND)), # CLASS_HIGH
+        # STATE_CSI
+        (('_illegal_syntax', STATE_GROUND), # CLASS_CONTROL
+         ('_illegal_syntax', STATE_GROUND), # CLASS_BACKSPACE
+         ('_illegal_syntax', STATE_GROUND), # CLASS_LINE_FEED
+         ('_illegal_syntax', STATE_GROUND), # CLASS_CARRIAGE_RETURN
+         ('_illegal_syntax', STATE_GROUND), # CLASS_ESCAPE
+         ('_collect_escape', STATE_CSI), # CLASS_PARAMETER
+         ('_dispatch_escape', STATE_GROUND), # CLASS_CSI
+         ('_dispatch_escape', STATE_GROUND), # CLASS_FINAL
+         ('_illegal_syntax', STATE_GROUND)), # CLASS_HIGH
+    )
+
+    # Names of the CSI escape handler methods keyed by the final byte of the escape
+    CSI_HANDLERS = {
+        ord(b'A'): 'handle_cursor_up',
+        ord(b'B'): 'handle_cursor_down',
+        ord(b'C'): 'handle_cursor_forward',
+        ord(b'D'): 'handle_cursor_back',
+        ord(b'E'): 'handle_cursor_next_line',
+        ord(b'F'): 'handle_cursor_previous_line',
+        ord(b'G'): 'handle_cursor_horizontal_absolute',
+        ord(b'H'): 'handle_cursor_position',
+        ord(b'f'): 'handle_cursor_position',
+        ord(b'J'): 'handle_erase_display',
+        ord(b'K'): 'handle_erase_line',
+        ord(b'h'): 'handle_ignored',
+        ord(b'l'): 'handle_ignored',
+        ord(b't'): 'handle_ignored',
+        ord(b'm'): 'handle_sgr',
+        ord(b'z'): 'handle_tiledata',
+    }
@@ -335,23 +335,48 @@ class TestParser(unittest.TestCase):
         self._assert_attributes([])
 
     def test_sgr_args(self):
-        """Test that only the custom color sgrs are allowed arguments."""
-        # This test is currently really slow. Either catching exceptions
-        # or re-constructing the parser is taking longer than expected.
-        worked = 0
+        """Test SGRs with several codes, and the arguments of the custom colors."""
+        self.parser.parse_bytes(b'\x1b[ 1 ; 31 ; 4 m')
+        self._assert_attributes([screen.ATTR_BOLD, screen.ATTR_UNDERLINE, screen.ATTR_RED_FG])
+        # later codes override earlier ones, and empty codes are 0
+        self.parser.parse_bytes(b'\x1b[ 32 ; 22 ; 7 ; ; 34 m')
+        self._assert_attributes([screen.ATTR_BLUE_FG])
+        self.parser.parse_bytes(b'\x1b[ 38 ; 5 ; 3 ; 1 ; 48 ; 2 ; 1 ; 2 ; 3 m')
+        self._assert_attributes([screen.ATTR_BOLD, screen.ATTR_SET_COLOR_FG,
+                                 screen.ATTR_SET_COLOR_BG])
+        self.parser.parse_bytes(b'\x1b[ 0 ; 21 m')
+        self._assert_attributes([screen.ATTR_2X_UNDERLINE])
+
+        # every code can be combined with others
         for code in range(0, 50):
-            for num_args in range(1, 6):
-                try:
-                    self.parser.parse_bytes((b'\x1b[ %d '+(b' ; 9 '*num_args)+b' m') % code)
-                    # only a few cases should actually work
-                    self.assertTrue(num_args in (2, 4))
-                    self.assertTrue(code in (screen.ATTR_SET_COLOR_FG, screen.ATTR_SET_COLOR_BG))
-                    worked += 1
-                except parser.ParseException:
-                    # This is generally what we expect. Parser is invalid after exception reset.
-                    self.parser = parser.Parser()
-        # make sure the right number entered the "worked" case (otherwise would pass if all raised)
-        self.assertEqual(4, worked)
+            if code in (screen.ATTR_SET_COLOR_FG, screen.ATTR_SET_COLOR_BG):
+                continue
+            parser_ = parser.Parser()
+            parser_.parse_bytes(b'\x1b[ 1 ; %d ; 9 m' % code)
+            expected = parser.Parser()
+            expected.parse_bytes(b'\x1b[ 1 m\x1b[ %d m\x1b[ 9 m' % code)
+            self.assertEqual(expected.screen.current_attributes.bitmap,
+                             parser_.screen.current_attributes.bitmap, code)
+
+        # the custom colors need 5;n or 2;r;g;b
+        for args in (b'', b';9', b';9;9', b';5', b';2;1;1', b';9;9;9;9'):
+            with self.assertRaises(parser.ParseException):
+                parser.Parser().parse_bytes(b'\x1b[38%sm' % args)
+        with self.assertRaises(parser.ParseException):
+            parser.Parser().parse_bytes(b'\x1b[' + b'1;' * parser.MAX_ESCAPE_ARGS + b'1m')
+
+        # bright colors map onto the normal ones, other codes past the stored
+        # bitmap are ignored rather than overflowing it
+        self.parser.parse_bytes(b'\x1b[0;63mA')
+        self._assert_attributes([63])
+        for (data, attrs) in ((b'\x1b[2;91mA', [screen.ATTR_BOLD, screen.ATTR_RED_FG]),
+                              (b'\x1b[32;107mA', [screen.ATTR_GREEN_FG, screen.ATTR_WHITE_BG]),
+                              (b'\x1b[120mx', []), (b'\x1b[1;64;99m', [screen.ATTR_BOLD])):
+            for tokenize in (False, True):
+                parser_ = parser.Parser(tokenize=tokenize)
+                parser_.parse_bytes(data)
+                self.assertEqual(attrs, list(parser_.screen.current_attributes.enumerate()),
+                                 data)
 
     def test_nethack_eod(self):
         """Test the nethack end-of-data escape"""
@@ -404,6 +429,38 @@ class TestParser(unittest.TestCase):
         self.parser.parse_bytes(b'e')
         self.assertEqual(self.screen.windows[screen.BASE_WINDOW].char_data[5][1].char, ord(b'e'))
 
+    def test_frames(self):
+        """Test that parsing produces a frame of change events per end-of-data."""
+        self.parser.parse_bytes(b'\x1b[ 1 ; 2 ; 3 z\x1b[ 5 ; 5 H\x1b[ 1 ; 0 ; 7 ; 9 z@'
+                                b'\x1b[ 1 ; 1 z\x1b[ 1 ; 3 z\x1b[ 1 ; 2 ; 1 zHi\x1b[ 1 ; 3 z')
+        self.assertEqual([[(screen.EVENT_WINDOW_SWITCHED, screen.MAP_WINDOW),
+                           (screen.EVENT_TILE_CHANGED, screen.MAP_WINDOW, 5, 5),
+                           (screen.EVENT_CELLS_CHANGED, screen.MAP_WINDOW, 5, 5, 5),
+                           (screen.EVENT_CURSOR_MOVED, 6, 5),
+                           (screen.EVENT_END_OF_DATA,)],
+                          [(screen.EVENT_WINDOW_SWITCHED, screen.MSG_WINDOW),
+                           (screen.EVENT_CELLS_CHANGED, screen.MSG_WINDOW, 6, 7, 5),
+                           (screen.EVENT_CURSOR_MOVED, 8, 5),
+                           (screen.EVENT_END_OF_DATA,)]],
+                         list(self.screen.iter_frames()))
+
+        # printing outside a tile escape clears the tile, even if the char is the same
+        for tokenize in (False, True):
+            for data in (b'@', b'@@'):
+                parser_ = parser.Parser(tokenize=tokenize)
+                parser_.parse_bytes(b'\x1b[1;2;3z\x1b[5;5H\x1b[1;0;7;9z@\x1b[1;1z\x1b[1;3z')
+                list(parser_.screen.iter_frames())
+                parser_.parse_bytes(b'\x1b[5;5H' + data + b'\x1b[1;3z')
+                (frame,) = parser_.screen.iter_frames()
+                self.assertEqual((screen.EVENT_TILE_CHANGED, screen.MAP_WINDOW, 5, 5), frame[0])
+                self.assertIsNone(parser_.screen.get_data(screen.MAP_WINDOW, 5, 5).tile_num)
+
+        # Recording can be turned off
+        parser_ = parser.Parser(record_events=False)
+        parser_.parse_bytes(b'\x1b[1;2;3z\x1b[5;5H\x1b[1;0;7;9z@\x1b[1;1z\x1b[1;3z')
+        self.assertEqual([], list(parser_.screen.iter_frames()))
+        self.assertEqual(ord(b'@'), parser_.screen.get_data(screen.MAP_WINDOW, 5, 5).char)
+
     def test_tiledata(self):
         """Test writing tiledata into the map window"""
         # switch to the map window
@@ -428,5 +485,168 @@ class TestParser(unittest.TestCase):
         self.assertEqual(None, data.tile_num)
         self.assertEqual(None, data.tile_flag)
 
+        # tile numbers and flags must fit the tile arrays
+        parser_ = parser.Parser()
+        parser_.parse_bytes(b'\x1b[1;2;3z\x1b[1;0;%d;%dz@\x1b[1;1z' %
+                            (screen.MAX_TILE_VALUE, screen.MAX_TILE_VALUE))
+        for args in (b'3000000000;0', b'1;2147483648'):
+            with self.assertRaises(parser.ParseException):
+                parser_.parse_bytes(b'\x1b[1;0;%sz' % args)
+
+    def test_printable_runs(self):
+        """Test that parsing a chunk with runs of printable bytes gives the same
+           screen as feeding the parser one byte at a time."""
+        data = (b'\x1b[ 1 ; 2 ; 1 zHello there\x1b[ 31 m world\r\nNext line\b!'
+                b'\x1b[ 1 ; 2 ; 3 z\x1b[ 5 ; 5 H\x1b[ 1 ; 0 ; 7 ; 9 z@\x1b[ 1 ; 1 zab'
+                b'\x1b[ 1 ; 2 ; 2 z\x1b[ 23 ; 70 H' + b'0123456789abcdef' +
+                b'\x1b[ 1 ; 3 z')
+        other = parser.Parser()
+        for byte in data:
+            other.parse_byte(byte)
+        self.parser.parse_bytes(data)
+        self.assertTrue(self.parser.end_of_data)
+        self.assertEqual((other.screen.cursor_x, other.screen.cursor_y),
+                         (self.screen.cursor_x, self.screen.cursor_y))
+        for win in range(screen.MAX_WINDOWS):
+            for row, other_row in zip(self.screen.enumerate_range(win, 1, screen.COLUMNS,
+                                                                  1, screen.ROWS),
+                                      other.screen.enumerate_range(win, 1, screen.COLUMNS,
+                                                                   1, screen.ROWS)):
+                self.assertEqual([(data.char, data.attributes.bitmap, data.dirty)
+                                  for data in other_row],
+                                 [(data.char, data.attributes.bitmap, data.dirty)
+                                  for data in row])
+        data = self.screen.windows[screen.MAP_WINDOW].char_data[6][5]
+        self.assertEqual(ord(b'a'), data.char)
+        self.assertEqual(None, data.tile_num)
+        data = self.screen.windows[screen.MAP_WINDOW].char_data[5][5]
+        self.assertEqual(7, data.tile_num)
+        self.assertEqual(ord(b'f'),
+                         self.screen.windows[screen.STATUS_WINDOW].char_data[80][23].char)
+
+    def test_run_in_tile(self):
+        """A run of printable bytes can't sneak a second char into a tile escape."""
+        self.parser.parse_bytes(b'\x1b[ 1 ; 2 ; 3 z\x1b[ 1 ; 0 ; 7 ; 9 z')
+        with self.assertRaises(parser.ParseException):
+            self.parser.parse_bytes(b'ab')
+
+    def test_csi_handlers(self):
+        """Test registering extra CSI handlers, and that unknown ones are rejected."""
+        seen = list()
+        self.parser.add_csi_handler(ord(b'S'), seen.append)
+        self.parser.parse_bytes(b'\x1b[ 3 S')
+        self.assertEqual([b'[ 3 '], seen)
+        self.assertEqual([3], list(self.parser.parse_escape_args(seen[0], (1,))))
+
+        # Only this parser got the new handler
+        with self.assertRaises(parser.ParseException):
+            parser.Parser().parse_bytes(b'\x1b[ 3 S')
+
+        with self.assertRaises(ValueError):
+            self.parser.add_csi_handler(ord(b'1'), seen.append)
+
+        with self.assertRaises(parser.ParseException):
+            self.parser.parse_bytes(b'\x1b[ 3 T')
+
+        # subclasses can override handlers, and add their own with a copy of the table
+        class UpParser(parser.Parser):
+            """Counts cursor up escapes and handles S"""
+            CSI_HANDLERS = {**parser.Parser.CSI_HANDLERS, ord(b'S'): 'handle_scroll_up'}
+
+            def handle_cursor_up(self, seq):
+                seen.append(seq)
+                super().handle_cursor_up(seq)
+
+            def handle_scroll_up(self, seq):
+                """Scroll Up"""
+                seen.append(seq)
+
+        seen.clear()
+        for tokenize in (False, True):
+            parser_ = UpParser(tokenize=tokenize)
+            parser_.parse_bytes(b'\x1b[5;5H\x1b[3A\x1b[2S')
+            self.assertEqual(2, parser_.screen.cursor_y)
+        self.assertEqual([b'[3', b'[2'] * 2, seen)
+        self.assertNotIn(ord(b'S'), parser.Parser.CSI_HANDLERS)
+
+    def test_escape_args(self):
+        """Test parsing escape arguments, including the cached repeats."""
+        for _ in range(2):
+            self.assertEqual((1, 0, 1234, 0),
+                             self.parser.parse_escape_args(bytearray(b'[1;0;1234;0'),
+                                                           (None, None, None, None)))
+            self.assertEqual((1, 3, None, None),
+                             self.parser.parse_escape_args(b'[ 1 ; 3 ', (None, None, None, None)))
+            self.assertEqual((7, 1), self.parser.parse_escape_args(b'[ 7 ;', (1, 1)))
+            self.assertEqual((1, 56), self.parser.parse_escape_args(b'[;56', (1, 1)))
+            self.assertEqual((0,), self.parser.parse_escape_args(b'[', (0,)))
+            self.assertEqual((0,), self.parser.parse_escape_args(b'[ ', (0,)))
+        for seq in (b'[1;2', b'[;', b'[1 2', b'[x', b'[-1', b'[1:2'):
+            with self.assertRaises(parser.ParseException):
+                self.parser.parse_escape_args(seq, (0,))
+
+    def test_escape_syntax(self):
+        """Test the state machine on escape syntax, including the bytes that
+           mean different things in different states."""
+        self.assertEqual(parser.CLASS_CSI, parser.BYTE_CLASSES[ord(b'[')])
+        self.assertEqual(parser.CLASS_HIGH, parser.BYTE_CLASSES[0xff])
+        # two escapes in a row are nothing, '[' outside an escape is a char
+        self.parser.parse_bytes(b'\x1b\x1b[\x1b[2C[')
+        self.assertEqual(parser.STATE_GROUND, self.parser.state)
+        self.assertEqual(ord(b'['), self.screen.get_data(screen.BASE_WINDOW, 1, 1).char)
+        self.assertEqual(ord(b'['), self.screen.get_data(screen.BASE_WINDOW, 4, 1).char)
+        # an escape split over chunks
+        self.parser.parse_bytes(b'\x1b')
+        self.assertEqual(parser.STATE_ESCAPE, self.parser.state)
+        self.parser.parse_bytes(b'[1')
+        self.assertEqual(parser.STATE_CSI, self.parser.state)
+        self.parser.parse_bytes(b'0G')
+        self.assertEqual(10, self.screen.cursor_x)
+        # the escape buffer has a fixed size
+        self.parser.parse_bytes(b'\x1b[' + b' ' * (parser.MAX_ESCAPE_LENGTH - 1) + b'm')
+        with self.assertRaises(parser.ParseException):
+            self.parser.parse_bytes(b'\x1b[' + b' ' * parser.MAX_ESCAPE_LENGTH + b'm')
+        for data in (b'\x1bx', b'\x1b\n', b'\x1b[1\x1b', b'\x1b[1\n', b'\x1b[\xff'):
+            with self.assertRaises(parser.ParseException):
+                parser.Parser().parse_bytes(data)
+
+    def test_tokenize(self):
+        """The tokenizer mode gives the same screen as the state machine, with
+           escapes split across chunks at every possible point."""
+        data = (b'\x1b[1;2;1zHello\x1b\x1b[there\x1b[31m world\r\nNext\x07 line\b!'
+                b'\x1b[1;2;3z\x1b[5;5H\x1b[1;0;7;9z@\x1b[1;1zab\x1b[0m\x1b[K'
+                b'\x1b[1;2;2z\x1b[23;70H0123456789abcdef\x1b[1;3z')
+        expected = parser.Parser()
+        expected.parse_bytes(data)
+        expected_snapshot = expected.screen.snapshot()
+        for split in range(len(data)):
+            tokenizer = parser.Parser(tokenize=True)
+            tokenizer.parse_bytes(data[:split])
+            tokenizer.parse_bytes(memoryview(data)[split:])
+            self.assertEqual(b'', tokenizer.carry)
+            self.assertTrue(tokenizer.end_of_data)
+            self.assertEqual(expected_snapshot, tokenizer.screen.snapshot(), split)
+
+        tokenizer = parser.Parser(tokenize=True)
+        tokenizer.parse_bytes(b'abc\x1b[12')
+        self.assertEqual((b'\x1b[12', False), (tokenizer.carry, tokenizer.end_of_data))
+        for data in (b'\x1bx', b'\x1b[1\x1b', b'\x1b[\xff', b'\x1b[1;2;3z\x1b[1;0;7;9zab'):
+            with self.assertRaises(parser.ParseException):
+                parser.Parser(tokenize=True).parse_bytes(data)
+
+        # the escape length limit applies to tokens and to the carry too
+        longest = b'\x1b[' + b' ' * (parser.MAX_ESCAPE_LENGTH - 1)
+        for tokenize in (False, True):
+            parser.Parser(tokenize=tokenize).parse_bytes(longest + b'H')
+            with self.assertRaises(parser.ParseException):
+                parser.Parser(tokenize=tokenize).parse_bytes(longest + b' H')
+            tokenizer = parser.Parser(tokenize=tokenize)
+            tokenizer.parse_bytes(longest)
+            with self.assertRaises(parser.ParseException):
+                tokenizer.parse_bytes(b' ')
+            self.assertLessEqual(len(tokenizer.carry), len(longest))
+        with self.assertRaises(parser.ParseException):
+            parser.Parser(tokenize=True).parse_bytes(b'\x1b[' + b' ' * 100 + b'H')
+
 if __name__ == '__main__':
     unittest.main()
@@ -11,8 +11,9 @@ import server
 
 def child_main():
     """Read from my stdin and send to the parser as
-       well as to stdout"""
-    parser_ = parser.Parser()
+       well as to stdout. Nobody reads the change events, so
+       don't let them pile up."""
+    parser_ = parser.Parser(record_events=False)
 
     data = sys.stdin.buffer.read(1)
     while data:
@@ -0,0 +1,273 @@
+"""Run many nethack games at once. The games are spread over worker processes,
+   each game paired with its own parser, and the parsed frames come back to
+   the controlling process over a queue."""
+
+import collections
+import multiprocessing
+import os
+import pickle
+import queue
+import select
+import time
+
+import parser
+import server
+
+# Commands from the pool to a worker, the first item of each tuple
+CMD_WRITE = 1 # (CMD_WRITE, game_id, bytes)
+CMD_RESTART = 2 # (CMD_RESTART, game_id)
+CMD_STOP = 3 # (CMD_STOP,)
+
+# A parsed frame from one game, along with that game's running stats.
+# frame_num counts from 0 for each run of the game, screen is a copy of its
+# ScreenData and events are the screen's frames of change events since the
+# previous Frame (see ScreenData.iter_frames).
+Frame = collections.namedtuple('Frame', ('game_id', 'frame_num', 'screen', 'events',
+                                         'bytes_read', 'restarts'))
+
+# Totals over all the frames received from a GamePool
+PoolStats = collections.namedtuple('PoolStats', ('frames', 'bytes_read', 'restarts'))
+
+# How many times to try starting nethack before giving up on a game, and the
+# seconds to wait between tries
+MAX_START_ATTEMPTS = 3
+START_RETRY_DELAY = 0.1
+
+class StartException(Exception):
+    """Raised when a game's nethack subprocess can't be started. A worker puts
+       it on the results queue in place of a Frame and drops the game."""
+
+class Game: # pylint: disable=too-many-instance-attributes
+    """One nethack subprocess in a worker with its parser and stats."""
+
+    def __init__(self, game_id, command):
+        """Start the game running the given command (a sequence of args)"""
+        self.game_id = game_id
+        self.command = command
+        self.bytes_read = 0
+        self.restarts = 0
+        self.nethack = None
+        self.parser = None
+        self.frame_num = 0
+        self.last_data = 0.0
+        self.start()
+
+    def start(self):
+        """(Re)start the nethack subprocess with a fresh parser. Raises
+           StartException if it fails MAX_START_ATTEMPTS times."""
+        for attempt in range(MAX_START_ATTEMPTS):
+            try:
+                self.nethack = server.SubprocessNethack(*self.command)
+                break
+            except OSError as exc:
+                if attempt + 1 == MAX_START_ATTEMPTS:
+                    raise StartException('Game '+str(self.game_id)+' failed to start: '+
+                                         str(exc)) from exc
+                time.sleep(START_RETRY_DELAY)
+        self.parser = parser.Parser()
+        self.frame_num = 0
+        self.last_data = time.monotonic()
+
+    def restart(self):
+        """Terminate the subprocess and start another one"""
+        self.nethack.terminate()
+        self.restarts += 1
+        self.start()
+
+    def fileno(self):
+        """The pty of the subprocess, so games can be passed to select"""
+        return self.nethack.io_pty.fileno()
+
+    def make_frame(self):
+        """Return the Frame for the current screen and move on to the next frame.
+           The screen is pickled right away, as the queue only pickles it later
+           in another thread while the parser may be changing it."""
+        screen = self.parser.screen
+        events = list(screen.iter_frames())
+        frame = Frame(self.game_id, self.frame_num, pickle.dumps(screen), events,
+                      self.bytes_read, self.restarts)
+        self.frame_num += 1
+        return frame
+
+    def read(self):
+        """Read and parse whatever the subprocess has ready. Returns a Frame if
+           this completed one, else None. Restarts the game once everything
+           nethack sent before exiting has been read, or if it sent something
+           the parser can't handle."""
+        try:
+            data = self.nethack.read_view(0)
+        except OSError:
+            # the pty failed some other way than reaching the end of file
+            self.restart()
+            return None
+        if data is None:
+            return None
+        if not data:
+            # end of file, nethack has exited
+            self.restart()
+            return None
+        self.bytes_read += len(data)
+        self.last_data = time.monotonic()
+        try:
+            self.parser.parse_bytes(data)
+        except parser.ParseException:
+            self.restart()
+            return None
+        if self.parser.end_of_data:
+            return self.make_frame()
+        return None
+
+    def idle_frame(self, timeout):
+        """Without tiledata there is no end-of-data escape, so the frame is over
+           once the game has been idle for timeout seconds. Returns the Frame in
+           that case, else None."""
+        if (self.parser.seen_tiledata or self.parser.end_of_data or
+                time.monotonic() - self.last_data < timeout):
+            return None
+        # end the idle frame so it is only reported once
+        self.parser.end_frame()
+        return self.make_frame()
+
+def _set_affinity(worker_num):
+    """Internal function: pin the worker process to one core, where supported"""
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, (cores[worker_num % len(cores)],))
+
+def _call_game(games, game, results, func):
+    """Internal function: call one of game's methods that may restart it.
+       If it can't be started again the StartException goes on results and
+       the game is dropped from games. Returns what func returned."""
+    try:
+        return func()
+    except StartException as exc:
+        del games[game.game_id]
+        results.put(exc)
+        return None
+
+def _handle_command(games, cmd, results):
+    """Internal function: carry out a CMD_WRITE or CMD_RESTART in a worker"""
+    game = games.get(cmd[1])
+    if game is None:
+        # it failed to start, which was already reported
+        return
+    if cmd[0] == CMD_WRITE:
+        try:
+            game.nethack.write(cmd[2])
+        except OSError:
+            pass # nethack exited, it restarts once the read sees that
+    elif cmd[0] == CMD_RESTART:
+        _call_game(games, game, results, game.restart)
+
+def _worker_main(worker_num, command, game_ids, commands, results, timeout): # pylint: disable=too-many-arguments
+    """Entry point of a worker process. Runs the games with the given ids until
+       CMD_STOP arrives on the commands queue, putting each Frame on results,
+       or a StartException for a game that can't be started."""
+    _set_affinity(worker_num)
+    games = dict()
+    for game_id in game_ids:
+        try:
+            games[game_id] = Game(game_id, command)
+        except StartException as exc:
+            results.put(exc)
+    try:
+        while True:
+            try:
+                while True:
+                    cmd = commands.get_nowait()
+                    if cmd[0] == CMD_STOP:
+                        return
+                    _handle_command(games, cmd, results)
+            except queue.Empty:
+                pass
+            (readable, _, _) = select.select(list(games.values()), (), (), 0.05)
+            for game in readable:
+                frame = _call_game(games, game, results, game.read)
+                if frame is not None:
+                    results.put(frame)
+            for game in games.values():
+                frame = game.idle_frame(timeout)
+                if frame is not None:
+                    results.put(frame)
+    finally:
+        for game in games.values():
+            game.nethack.terminate()
+
+class GamePool:
+    """Launches num_games copies of nethack spread over worker processes (by
+       default one per core), each game with its own Parser. Frames are
+       returned from get_frame, in the order they complete across all games.
+       Games that exit or produce unparseable output are restarted, a game
+       that can't be started makes get_frame raise StartException."""
+
+    def __init__(self, num_games, command=(server.SubprocessNethack.DEFAULT_NH,),
+                 processes=None, timeout=1.0):
+        """Start the games. command is the args to run each game, processes is
+           the number of worker processes (None for one per core) and timeout
+           is how long a game without tiledata must be idle to end a frame."""
+        processes = min(processes or os.cpu_count() or 1, num_games)
+        self.num_games = num_games
+        self.results = multiprocessing.Queue()
+        self.commands = list()
+        self.workers = list()
+        self.frames = 0
+        self.game_stats = dict()
+        for worker_num in range(processes):
+            commands = multiprocessing.Queue()
+            game_ids = range(worker_num, num_games, processes)
+            worker = multiprocessing.Process(target=_worker_main,
+                                             args=(worker_num, tuple(command), game_ids,
+                                                   commands, self.results, timeout),
+                                             daemon=True)
+            worker.start()
+            self.commands.append(commands)
+            self.workers.append(worker)
+
+    def _worker_commands(self, game_id):
+        """Internal function: the command queue of the worker running game_id"""
+        if not 0 <= game_id < self.num_games:
+            raise ValueError('No such game: '+str(game_id))
+        return self.commands[game_id % len(self.workers)]
+
+    def write(self, game_id, bytes_):
+        """Write data to the stdin of the given game"""
+        self._worker_commands(game_id).put((CMD_WRITE, game_id, bytes(bytes_)))
+
+    def restart(self, game_id):
+        """Restart the given game from scratch"""
+        self._worker_commands(game_id).put((CMD_RESTART, game_id))
+
+    def get_frame(self, timeout=None):
+        """Return the next Frame from any game, or None if there isn't one
+           by the timeout (None to wait forever). Raises StartException if
+           a game couldn't be started, after which it sends no more frames."""
+        try:
+            frame = self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if isinstance(frame, StartException):
+            raise frame
+        self.frames += 1
+        self.game_stats[frame.game_id] = (frame.bytes_read, frame.restarts)
+        return frame._replace(screen=pickle.loads(frame.screen))
+
+    def stats(self):
+        """Return PoolStats totalled over the frames received so far."""
+        return PoolStats(self.frames,
+                         sum(bytes_read for (bytes_read, _) in self.game_stats.values()),
+                         sum(restarts for (_, restarts) in self.game_stats.values()))
+
+    def stop(self):
+        """Stop all the workers, terminating their games."""
+        for commands in self.commands:
+            commands.put((CMD_STOP,))
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,157 @@
+"""unittests for the pool module"""
+
+import pickle
+import select
+import sys
+import unittest
+
+import pool
+import screen
+
+# A stand-in for nethack, shows the turn number in the message window as a
+# tiledata frame, then waits for a line of input before the next turn
+TURN_SCRIPT = '''
+import sys
+turn = 0
+try:
+    while True:
+        sys.stdout.write('\\x1b[1;2;1z\\x1b[Hturn %d\\x1b[K\\x1b[1;3z' % turn)
+        sys.stdout.flush()
+        if sys.stdin.readline().strip() == 'quit':
+            break
+        turn += 1
+except OSError:
+    pass # the pool closed the pty
+'''
+
+# A stand-in for nethack without tiledata, so frames end when it goes idle
+IDLE_SCRIPT = '''
+import sys
+import time
+sys.stdout.write('hello')
+sys.stdout.flush()
+time.sleep(10)
+'''
+
+# A stand-in for nethack that sends one tiledata frame and exits straight away
+EXIT_SCRIPT = '''
+import sys
+sys.stdout.write('\\x1b[1;2;1z\\x1b[Hbye\\x1b[K\\x1b[1;3z')
+sys.stdout.flush()
+'''
+
+# A command that can't be started
+MISSING_COMMAND = ('/nonexistent/nethack',)
+
+def message(frame):
+    """Return the first message line of the frame's screen as bytes"""
+    return bytes(data.char or 32 for data in
+                 frame.screen.enumerate_row(screen.MSG_WINDOW, 1, 10, 1)).strip()
+
+class TestGamePool(unittest.TestCase):
+    """Test the game pool with the turn script instead of nethack."""
+
+    def setUp(self):
+        """The fixture is a pool of 3 games in 2 worker processes"""
+        self.pool = pool.GamePool(3, command=(sys.executable, '-c', TURN_SCRIPT), processes=2)
+
+    def tearDown(self):
+        """Stop the workers after each test"""
+        self.pool.stop()
+
+    def _get_frames(self, count):
+        """Get count frames, failing if they take too long"""
+        frames = list()
+        for _ in range(count):
+            frame = self.pool.get_frame(timeout=10)
+            self.assertIsNotNone(frame)
+            frames.append(frame)
+        return frames
+
+    def test_frames(self):
+        """Each game produces its first frame, then another after input."""
+        frames = self._get_frames(3)
+        self.assertEqual([0, 1, 2], sorted(frame.game_id for frame in frames))
+        for frame in frames:
+            self.assertEqual(0, frame.frame_num)
+            self.assertEqual(b'turn 0', message(frame))
+            self.assertEqual(screen.EVENT_END_OF_DATA, frame.events[-1][-1][0])
+
+        self.pool.write(1, b'x\n')
+        frame = self._get_frames(1)[0]
+        self.assertEqual((1, 1), (frame.game_id, frame.frame_num))
+        self.assertEqual(b'turn 1', message(frame))
+
+        stats = self.pool.stats()
+        self.assertEqual(4, stats.frames)
+        self.assertGreater(stats.bytes_read, 0)
+        self.assertEqual(0, stats.restarts)
+
+        with self.assertRaises(ValueError):
+            self.pool.write(3, b'x\n')
+
+    def test_restart(self):
+        """Games are restarted on request and when they exit."""
+        self._get_frames(3)
+        self.pool.restart(0)
+        frame = self._get_frames(1)[0]
+        self.assertEqual((0, 0, 1), (frame.game_id, frame.frame_num, frame.restarts))
+
+        self.pool.write(2, b'quit\n')
+        frame = self._get_frames(1)[0]
+        self.assertEqual((2, 0, 1), (frame.game_id, frame.frame_num, frame.restarts))
+        self.assertEqual(b'turn 0', message(frame))
+        self.assertEqual(2, self.pool.stats().restarts)
+
+class TestStartFailure(unittest.TestCase):
+    """Test a pool whose games can't be started."""
+
+    def test_start_failure(self):
+        """get_frame raises instead of waiting forever."""
+        with pool.GamePool(2, command=MISSING_COMMAND, processes=1) as pool_:
+            for _ in range(2):
+                with self.assertRaises(pool.StartException):
+                    pool_.get_frame(timeout=10)
+            self.assertIsNone(pool_.get_frame(timeout=0.2))
+
+class TestGame(unittest.TestCase):
+    """Test a single game without the worker processes."""
+
+    def test_idle_frame(self):
+        """Without tiledata the frame ends once the game is idle, only once."""
+        game = pool.Game(0, (sys.executable, '-c', IDLE_SCRIPT))
+        try:
+            select.select((game,), (), (), 10)
+            self.assertIsNone(game.read())
+            self.assertIsNone(game.idle_frame(60))
+            frame = game.idle_frame(0)
+            self.assertIsNone(game.idle_frame(0))
+        finally:
+            game.nethack.terminate()
+        self.assertEqual([(screen.EVENT_END_OF_DATA,)], [events[-1] for events in frame.events])
+        self.assertEqual([], game.parser.screen.pending_events)
+
+    def test_exit(self):
+        """Output sent before nethack exits is parsed before the restart."""
+        game = pool.Game(0, (sys.executable, '-c', EXIT_SCRIPT))
+        try:
+            game.nethack.subproc.wait(10)
+            frame = None
+            while frame is None:
+                select.select((game,), (), (), 10)
+                frame = game.read()
+            frame = frame._replace(screen=pickle.loads(frame.screen))
+            self.assertEqual((b'bye', 0), (message(frame), frame.restarts))
+            select.select((game,), (), (), 10)
+            self.assertIsNone(game.read())
+            self.assertEqual(1, game.restarts)
+        finally:
+            game.nethack.terminate()
+
+    def test_start_failure(self):
+        """Starting is tried MAX_START_ATTEMPTS times before giving up."""
+        with self.assertRaises(pool.StartException):
+            pool.Game(0, MISSING_COMMAND)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 """Model of the screen contents of a nethack game.
    It uses vt_tiledata to distinguish between multiple
    windows"""
+# pylint: disable=too-many-lines
+
+import array
+import collections
 
 #These are the same as the VT100 SGR paramters.
 #Many of these are not used by nethack.
@@ -60,12 +64,17 @@ ATTR_WHITE_BG = 47
 ATTR_SET_COLOR_BG = 48
 ATTR_DEFAULT_BG = 49
 ATTR_BG_BITMASK = 0x3ff0000000000
+# The windows store attribute bitmaps as unsigned 64 bit ints, so attribute
+# numbers must be below this
+MAX_ATTRIBUTES = 64
 
 class CharAttributes:
     """Represent character attributes such as bold, reverse, color, etc.
        This is just a simple bitmap implementation, any extended meaning
        or mutual exclusion of attributes is implemented in the parser."""
 
+    __slots__ = ('bitmap',)
+
     def __init__(self):
         """Initializes an empty attributes object."""
         self.bitmap = 0
@@ -110,37 +119,130 @@ class CharAttributes:
            given bitmap."""
         target.bitmap = self.bitmap
 
+    def freeze(self):
+        """Return the interned FrozenAttributes with the current bitmap."""
+        return frozen_attributes(self.bitmap)
+
+class FrozenAttributes(CharAttributes):
+    """An immutable CharAttributes. These are interned, use frozen_attributes
+       to get one, so there is only ever one object for each bitmap and two
+       frozen attributes are equal only if they are the same object."""
+
+    __slots__ = ()
+
+    def __init__(self, bitmap): # pylint: disable=super-init-not-called
+        """Use frozen_attributes instead of constructing these directly."""
+        object.__setattr__(self, 'bitmap', bitmap)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenAttributes are immutable')
+
+    def set_mask(self, bitmask):
+        """Not allowed, FrozenAttributes are immutable."""
+        raise AttributeError('FrozenAttributes are immutable')
+
+    def clear_mask(self, bitmask):
+        """Not allowed, FrozenAttributes are immutable."""
+        raise AttributeError('FrozenAttributes are immutable')
+
+    def clear_all(self):
+        """Not allowed, FrozenAttributes are immutable."""
+        raise AttributeError('FrozenAttributes are immutable')
+
+# Interned FrozenAttributes by bitmap. Nethack only uses a few dozen
+# combinations of attributes so this stays small.
+_FROZEN_ATTRIBUTES = dict()
+
+def frozen_attributes(bitmap):
+    """Return the interned FrozenAttributes for the given bitmap."""
+    try:
+        return _FROZEN_ATTRIBUTES[bitmap]
+    except KeyError:
+        return _FROZEN_ATTRIBUTES.setdefault(bitmap, FrozenAttributes(bitmap))
+
 class CharData:
-    """Represents a single character with its attributes."""
+    """Represents a single character with its attributes. This is only a view
+       of one character in the window storage, so it always reflects the current
+       contents of the window and changes made through it go to the window."""
 
-    def __init__(self):
-        """The character data is initialize empty."""
-        self.attributes = CharAttributes()
-        self.char = None
-        self.dirty = False
+    __slots__ = ('window', 'index')
+
+    def __init__(self, window, index):
+        """Attach to the character at index in the window storage."""
+        self.window = window
+        self.index = index
+
+    @property
+    def char(self):
+        """The character as a byte value, or None if empty."""
+        return self.window.chars[self.index] or None
+
+    @char.setter
+    def char(self, value):
+        window = self.window
+        window.set_char_at(self.index, value or EMPTY_CHAR, window.attrs[self.index])
+
+    @property
+    def attributes(self):
+        """The attributes of the character as interned FrozenAttributes. Assign
+           any CharAttributes to change them."""
+        return frozen_attributes(self.window.attrs[self.index])
+
+    @attributes.setter
+    def attributes(self, value):
+        window = self.window
+        window.set_char_at(self.index, window.chars[self.index], value.bitmap)
+
+    @property
+    def dirty(self):
+        """True if the character has changed since the window was last set clean."""
+        (y, x) = divmod(self.index, STRIDE)
+        return bool(self.window.dirty_rows[y] >> x & 1)
+
+    @dirty.setter
+    def dirty(self, value):
+        (y, x) = divmod(self.index, STRIDE)
+        if value:
+            self.window.dirty_rows[y] |= 1 << x
+        else:
+            self.window.dirty_rows[y] &= ~(1 << x)
 
     def clear(self):
         """Reset the character data back to empty with no attributes."""
-        changed = self.char is not None or self.attributes.bitmap != 0
-        self.char = None
-        self.attributes.clear_all()
-        return changed
+        return self.window.set_char_at(self.index, EMPTY_CHAR, 0)
 
 class TileData(CharData):
     """Extends CharData to also include tiledata"""
 
-    def __init__(self):
-        """The tiledata implements empty."""
-        super().__init__()
-        self.tile_num = None
-        self.tile_flag = None
+    __slots__ = ()
+
+    @property
+    def tile_num(self):
+        """The tile number, or None if there is no tile."""
+        num = self.window.tile_nums[self.index]
+        return None if num == EMPTY_TILE else num
+
+    @tile_num.setter
+    def tile_num(self, value):
+        window = self.window
+        window.set_tile_at(self.index, EMPTY_TILE if value is None else value,
+                           window.tile_flags[self.index])
+
+    @property
+    def tile_flag(self):
+        """The tile flags, or None if there is no tile."""
+        flag = self.window.tile_flags[self.index]
+        return None if flag == EMPTY_TILE else flag
+
+    @tile_flag.setter
+    def tile_flag(self, value):
+        window = self.window
+        window.set_tile_at(self.index, window.tile_nums[self.index],
+                           EMPTY_TILE if value is None else value)
 
     def clear_tile(self):
         """Clear only the tile data"""
-        changed = self.tile_num is not None or self.tile_flag is not None
-        self.tile_num = None
-        self.tile_flag = None
-        return changed
+        return self.window.set_tile_at(self.index, EMPTY_TILE, EMPTY_TILE)
 
     def clear(self):
         """Reset the character data and tiledata back to empty."""
@@ -158,33 +260,281 @@ MAX_WINDOWS = 8
 COLUMNS = 80
 ROWS = 24
 
-class WindowData:
+# The window storage is row-major with an unused 0 row and column, so the
+# character at (x, y) is at index y*STRIDE + x
+STRIDE = COLUMNS + 1
+WINDOW_SIZE = (ROWS + 1) * STRIDE
+
+# Values stored for empty characters and tiles
+EMPTY_CHAR = 0
+EMPTY_TILE = -1
+# The windows store tile numbers and flags as C ints, so they can't be above this
+MAX_TILE_VALUE = 2**31 - 1
+
+# Change events recorded by ScreenData, the first item of each event tuple.
+# (EVENT_CELLS_CHANGED, window, start_x, end_x, y) - characters changed
+# (EVENT_TILE_CHANGED, window, x, y) - tiledata changed
+# (EVENT_CURSOR_MOVED, x, y) - cursor position at the end of the frame
+# (EVENT_WINDOW_SWITCHED, window) - current window changed
+# (EVENT_END_OF_DATA,) - always the last event in a frame
+EVENT_CELLS_CHANGED = 1
+EVENT_TILE_CHANGED = 2
+EVENT_CURSOR_MOVED = 3
+EVENT_WINDOW_SWITCHED = 4
+EVENT_END_OF_DATA = 5
+
+# Completed frames of events kept for iter_frames, the oldest are dropped
+MAX_PENDING_FRAMES = 64
+
+def mask_spans(mask):
+    """Return an iterator over the runs of set bits in mask as
+       (start_bit, end_bit) tuples, lowest bits first."""
+    while mask:
+        low_bit = mask & -mask
+        # adding the lowest bit carries through the run of set bits
+        after_run = (mask + low_bit) & ~mask
+        yield (low_bit.bit_length() - 1, after_run.bit_length() - 2)
+        mask &= ~(after_run - 1)
+
+def _cell_hash(index, char, bitmap):
+    """Internal function: what the character at index adds to a window's
+       content_hash, 0 if it is empty. Only ints are hashed so the hash is
+       the same in every process."""
+    return hash((index, char, bitmap)) if char or bitmap else 0
+
+def _tile_hash(index, num, flag):
+    """Internal function: what the tiledata at index adds to a window's
+       content_hash, 0 if there is no tile."""
+    return hash((-index, num, flag)) if num != EMPTY_TILE or flag != EMPTY_TILE else 0
+
+class WindowColumn:
+    """One column of a window, indexing it by y returns the CharData
+       (or TileData) for that character."""
+
+    __slots__ = ('window', 'x')
+
+    def __init__(self, window, x):
+        """Column x of the window"""
+        self.window = window
+        self.x = x
+
+    def __getitem__(self, y):
+        return self.window.get_data(self.x, y)
+
+class WindowColumns:
+    """Indexing by x returns the WindowColumn, so characters can be
+       reached with the natural char_data[x][y]."""
+
+    __slots__ = ('window',)
+
+    def __init__(self, window):
+        """Columns of the window"""
+        self.window = window
+
+    def __getitem__(self, x):
+        return WindowColumn(self.window, x)
+
+class WindowSnapshot: # pylint: disable=too-many-instance-attributes
+    """The saved contents of a WindowData, see WindowData.snapshot. The arrays
+       are shared with the window until the window next changes, so they must
+       not be modified. Snapshots with the same contents are equal and hash the
+       same, so they can be used to deduplicate windows."""
+
+    __slots__ = ('chars', 'attrs', 'tile_nums', 'tile_flags', 'content_hash', 'row_hashes',
+                 'char_rows', 'tile_rows')
+
+    def __init__(self, window):
+        """Share the storage arrays (and per row lists) of the window"""
+        self.chars = window.chars
+        self.attrs = window.attrs
+        self.tile_nums = window.tile_nums
+        self.tile_flags = window.tile_flags
+        self.content_hash = window.content_hash
+        self.row_hashes = window.row_hashes
+        self.char_rows = window.char_rows
+        self.tile_rows = window.tile_rows
+
+    def __hash__(self):
+        return self.content_hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, WindowSnapshot) or self.content_hash != other.content_hash:
+            return False
+        return (self.chars == other.chars and self.attrs == other.attrs and
+                self.tile_nums == other.tile_nums and self.tile_flags == other.tile_flags)
+
+class WindowData: # pylint: disable=too-many-instance-attributes
     """Represent an entire 80x25 "window" of data. Nethack emits an escape code
        before emitting characters which indicates which window the data is
        intended for. The window data object can also track what portion of
-       a window has changed with the "dirty" flags."""
+       a window has changed with the "dirty" flags. Each row has a bitmask of
+       its dirty columns, plus there is a bounding box of all the dirty data.
+
+       The characters are stored as parallel arrays: chars, attrs (bitmaps),
+       tile_nums and tile_flags, all indexed by y*STRIDE + x. The tile arrays
+       are None for windows without tile data. dirty_rows[y] has bit x set
+       if the character at (x, y) is dirty.
+
+       The arrays are copy-on-write once snapshot has been called: they are
+       shared with the WindowSnapshot until the next change, which copies them
+       first. Anything that writes to the arrays must call make_writable.
+
+       content_hash is a hash of the window contents, kept up to date by every
+       change so it never has to be recomputed. It is the xor of row_hashes,
+       and row_hashes[y] is the xor of a hash of each non-empty character and
+       tile in row y, which lets a change to a cell swap its old hash out and
+       the new one in. char_rows[y] (and tile_rows[y]) has bit x set if the
+       character (or tiledata) at (x, y) is not empty, so clearing only has to
+       look at the non-empty cells, and clearing all of a row's cells just
+       drops its row hash. These lists are copy-on-write along with the arrays,
+       tile_rows is all 0 for windows without tile data.
+
+       Windows with tile data also keep an index from each tile number to the
+       set of (x, y) positions it is at, see tile_positions. It is kept up to
+       date by every change, except that restore just drops it to be rebuilt
+       by the next lookup."""
 
     def __init__(self, use_tile_data):
         """Initialize the window into an array of empty characters, all of which
            are marked cleaned by default. Screen data is 1-based indexes. For
-           simplicity you can index the arrays naturally. The 0 row and columns
-           are filled with "Nones" and should not be accessed.
-           use_tile_data - if True fill the array with TileData, else CharData"""
+           simplicity you can index the char_data naturally with [x][y]. The 0
+           row and columns exist in the arrays but should not be accessed.
+           use_tile_data - if True the characters are TileData, else CharData"""
         self.dirty_x_max = None
         self.dirty_x_min = None
         self.dirty_y_max = None
         self.dirty_y_min = None
-        self.char_data = list()
-        self.char_data.append(None)
-        for _ in range(1, COLUMNS+1):
-            window_col = list()
-            window_col.append(None)
-            for _ in range(1, ROWS+1):
-                if use_tile_data:
-                    window_col.append(TileData())
-                else:
-                    window_col.append(CharData())
-            self.char_data.append(window_col)
+        self.use_tile_data = use_tile_data
+        self.chars = array.array('B', bytes(WINDOW_SIZE))
+        self.attrs = array.array('Q', bytes(WINDOW_SIZE * 8))
+        self.dirty_rows = [0] * (ROWS + 1)
+        if use_tile_data:
+            self.tile_nums = array.array('i', (EMPTY_TILE,)) * WINDOW_SIZE
+            self.tile_flags = array.array('i', (EMPTY_TILE,)) * WINDOW_SIZE
+        else:
+            self.tile_nums = None
+            self.tile_flags = None
+        # the WindowSnapshot sharing the arrays, None once they have been copied
+        self._saved = None
+        self.content_hash = 0
+        self.row_hashes = [0] * (ROWS + 1)
+        self.char_rows = [0] * (ROWS + 1)
+        self.tile_rows = [0] * (ROWS + 1)
+        # tile number -> set of (x, y), None when it needs rebuilding
+        self._tile_index = dict() if use_tile_data else None
+        self.char_data = WindowColumns(self)
+
+    def get_data(self, x, y):
+        """Return the CharData (or TileData) for the given coordinates."""
+        if self.use_tile_data:
+            return TileData(self, y*STRIDE + x)
+        return CharData(self, y*STRIDE + x)
+
+    def make_writable(self):
+        """Copy the arrays if they are shared with a snapshot, so they can be changed."""
+        if self._saved is not None:
+            self.chars = self.chars[:]
+            self.attrs = self.attrs[:]
+            self.row_hashes = self.row_hashes[:]
+            self.char_rows = self.char_rows[:]
+            if self.use_tile_data:
+                self.tile_nums = self.tile_nums[:]
+                self.tile_flags = self.tile_flags[:]
+                self.tile_rows = self.tile_rows[:]
+            self._saved = None
+
+    def snapshot(self):
+        """Return a WindowSnapshot of the contents of the window. This doesn't
+           copy anything, the window keeps sharing its arrays with the snapshot
+           until it changes. The dirty flags are not included."""
+        if self._saved is None:
+            self._saved = WindowSnapshot(self)
+        return self._saved
+
+    def restore(self, snapshot):
+        """Set the contents of the window back to those of the snapshot. The
+           arrays are shared with the snapshot again, so this doesn't copy
+           anything either. The dirty flags are left unchanged."""
+        self.chars = snapshot.chars
+        self.attrs = snapshot.attrs
+        self.tile_nums = snapshot.tile_nums
+        self.tile_flags = snapshot.tile_flags
+        self.content_hash = snapshot.content_hash
+        self.row_hashes = snapshot.row_hashes
+        self.char_rows = snapshot.char_rows
+        self.tile_rows = snapshot.tile_rows
+        self._saved = snapshot
+        self._tile_index = None
+
+    def tile_positions(self, num):
+        """Return a set of the (x, y) positions of the given tile number. This is
+           O(matches) from the tile index, unless the index has to be rebuilt
+           after a restore."""
+        if not self.use_tile_data:
+            return set()
+        if self._tile_index is None:
+            self._tile_index = dict()
+            for (index, tile_num) in enumerate(self.tile_nums):
+                if tile_num != EMPTY_TILE:
+                    self._index_tile(index, tile_num)
+        return set(self._tile_index.get(num, ()))
+
+    def _index_tile(self, index, num):
+        """Internal function: add the tile at index to the tile index"""
+        (y, x) = divmod(index, STRIDE)
+        positions = self._tile_index.get(num)
+        if positions is None:
+            self._tile_index[num] = {(x, y)}
+        else:
+            positions.add((x, y))
+
+    def _unindex_tile(self, index, num):
+        """Internal function: remove the tile at index from the tile index"""
+        (y, x) = divmod(index, STRIDE)
+        positions = self._tile_index[num]
+        positions.discard((x, y))
+        if not positions:
+            del self._tile_index[num]
+
+    def _unindex_tiles(self, y, mask):
+        """Internal function: remove the tiles in row y at the columns in mask
+           from the tile index"""
+        tile_nums = self.tile_nums
+        for (start_x, end_x) in mask_spans(mask):
+            for i in range(y*STRIDE + start_x, y*STRIDE + end_x + 1):
+                if tile_nums[i] != EMPTY_TILE:
+                    self._unindex_tile(i, tile_nums[i])
+
+    def _hash_cells(self, y, char_mask, tile_mask):
+        """Internal function: what the characters in row y at the columns in
+           char_mask and the tiles at the columns in tile_mask add to the row
+           hash. The cells must not be empty."""
+        result = 0
+        chars = self.chars
+        attrs = self.attrs
+        for (start_x, end_x) in mask_spans(char_mask):
+            for i in range(y*STRIDE + start_x, y*STRIDE + end_x + 1):
+                # _cell_hash of a non-empty cell
+                result ^= hash((i, chars[i], attrs[i]))
+        tile_nums = self.tile_nums
+        tile_flags = self.tile_flags
+        for (start_x, end_x) in mask_spans(tile_mask):
+            for i in range(y*STRIDE + start_x, y*STRIDE + end_x + 1):
+                result ^= hash((-i, tile_nums[i], tile_flags[i]))
+        return result
+
+    def get_dirty_state(self):
+        """Return the dirty flags and min/max coordinates as a tuple for set_dirty_state."""
+        return (tuple(self.dirty_rows), self.dirty_x_min, self.dirty_x_max,
+                self.dirty_y_min, self.dirty_y_max)
+
+    def set_dirty_state(self, state):
+        """Set the dirty flags and min/max coordinates back to a get_dirty_state tuple."""
+        (dirty_rows, self.dirty_x_min, self.dirty_x_max,
+         self.dirty_y_min, self.dirty_y_max) = state
+        self.dirty_rows[:] = dirty_rows
 
     def has_dirty_data(self):
         """Return True if any characters in the window are dirty."""
@@ -199,7 +549,7 @@ class WindowData:
         """Set the dirty flag on the character as the given coordinates.
            Both the flag on the character and the dirty min/max
            coordinates will be updated (if necessary)"""
-        self.char_data[x][y].dirty = True
+        self.dirty_rows[y] |= 1 << x
         if not self.has_dirty_data():
             self.dirty_x_min = x
             self.dirty_x_max = x
@@ -215,27 +565,267 @@ class WindowData:
             elif y > self.dirty_y_max:
                 self.dirty_y_max = y
 
+    def dirty_spans(self):
+        """Return an iterator over the minimal list of dirty spans in the window, as
+           (y, start_x, end_x) tuples ordered by row then column. Each span is a run
+           of dirty characters in a single row."""
+        if not self.has_dirty_data():
+            return
+        for y in range(self.dirty_y_min, self.dirty_y_max+1):
+            for (start_x, end_x) in mask_spans(self.dirty_rows[y]):
+                yield (y, start_x, end_x)
+
+    def _extend_dirty(self, x_min, x_max, y_min, y_max):
+        """Internal function: grow the dirty min/max coordinates to cover the
+           given rectangle."""
+        if not self.has_dirty_data():
+            self.dirty_x_min = x_min
+            self.dirty_x_max = x_max
+            self.dirty_y_min = y_min
+            self.dirty_y_max = y_max
+        else:
+            self.dirty_x_min = min(self.dirty_x_min, x_min)
+            self.dirty_x_max = max(self.dirty_x_max, x_max)
+            self.dirty_y_min = min(self.dirty_y_min, y_min)
+            self.dirty_y_max = max(self.dirty_y_max, y_max)
+
     def set_all_clean(self):
-        """Set all character data objects in the window as clean and
+        """Set all characters in the window as clean and
            reset the dirty min/max coordinates (to None)"""
         if not self.has_dirty_data():
             return
-        for x in range(self.dirty_x_min, self.dirty_x_max+1):
-            for y in range(self.dirty_y_min, self.dirty_y_max+1):
-                self.char_data[x][y].dirty = False
+        self.dirty_rows[self.dirty_y_min:self.dirty_y_max+1] = \
+            [0] * (self.dirty_y_max - self.dirty_y_min + 1)
         self.dirty_x_min = None
         self.dirty_x_max = None
         self.dirty_y_min = None
         self.dirty_y_max = None
 
-class ScreenData:
+    def set_char_at(self, index, char, bitmap):
+        """Set the character at the given index in the arrays, without marking
+           it dirty. Returns True if this changed the character."""
+        old_char = self.chars[index]
+        old_bitmap = self.attrs[index]
+        if old_char == char and old_bitmap == bitmap:
+            return False
+        if self._saved is not None:
+            self.make_writable()
+        self.chars[index] = char
+        self.attrs[index] = bitmap
+        (y, x) = divmod(index, STRIDE)
+        change = _cell_hash(index, old_char, old_bitmap) ^ _cell_hash(index, char, bitmap)
+        self.row_hashes[y] ^= change
+        self.content_hash ^= change
+        if char or bitmap:
+            self.char_rows[y] |= 1 << x
+        else:
+            self.char_rows[y] &= ~(1 << x)
+        return True
+
+    def set_tile_at(self, index, num, flag):
+        """Set the tiledata at the given index in the arrays, EMPTY_TILE for no
+           tile, without marking it dirty. Returns True if this changed the tiledata."""
+        old_num = self.tile_nums[index]
+        old_flag = self.tile_flags[index]
+        if old_num == num and old_flag == flag:
+            return False
+        if self._saved is not None:
+            self.make_writable()
+        self.tile_nums[index] = num
+        self.tile_flags[index] = flag
+        (y, x) = divmod(index, STRIDE)
+        change = _tile_hash(index, old_num, old_flag) ^ _tile_hash(index, num, flag)
+        self.row_hashes[y] ^= change
+        self.content_hash ^= change
+        if num != EMPTY_TILE or flag != EMPTY_TILE:
+            self.tile_rows[y] |= 1 << x
+        else:
+            self.tile_rows[y] &= ~(1 << x)
+        if old_num != num and self._tile_index is not None:
+            if old_num != EMPTY_TILE:
+                self._unindex_tile(index, old_num)
+            if num != EMPTY_TILE:
+                self._index_tile(index, num)
+        return True
+
+    def set_char(self, x, y, char, bitmap):
+        """Set the character at the given coordinates. If this changes the
+           character, mark it dirty and return True."""
+        if self.set_char_at(y*STRIDE + x, char, bitmap):
+            self.set_dirty(x, y)
+            return True
+        return False
+
+    def set_tile(self, x, y, num, flag):
+        """Set the tiledata at the given coordinates, None for no tile. If this
+           changes the tiledata, mark it dirty and return True."""
+        if self.set_tile_at(y*STRIDE + x, EMPTY_TILE if num is None else num,
+                            EMPTY_TILE if flag is None else flag):
+            self.set_dirty(x, y)
+            return True
+        return False
+
+    def clear_rect(self, start_x, end_x, start_y, end_y): # pylint: disable=too-many-locals
+        """Clear the characters (and tiledata) in the rectangle from (start_x, start_y)
+           to (end_x, end_y). Only characters that were not already empty are marked
+           dirty. The non-empty characters of each row come from char_rows and
+           tile_rows, so empty rows are skipped, rows that are emptied entirely
+           just drop their row hash and only the non-empty characters of the
+           rest are hashed. The arrays are cleared with slice assignments.
+           Returns a list of (y, mask, tile_mask) for the rows that changed, mask
+           has bit x set for each changed column and tile_mask for each column
+           whose tiledata was cleared."""
+        width = end_x - start_x + 1
+        rect_mask = ((1 << width) - 1) << start_x
+        changed = list()
+        for y in range(start_y, end_y+1):
+            mask = (self.char_rows[y] | self.tile_rows[y]) & rect_mask
+            if mask:
+                changed.append((y, mask, self.tile_rows[y] & rect_mask))
+        if not changed:
+            return changed
+        self.make_writable()
+        char_rows = self.char_rows
+        tile_rows = self.tile_rows
+        row_hashes = self.row_hashes
+        dirty_rows = self.dirty_rows
+        # if no tiles are left afterwards, start the tile index again rather
+        # than removing the tiles from it one at a time
+        tiles_left = self._tile_index is not None and any(
+            tile_rows[y] & ~rect_mask if start_y <= y <= end_y else tile_rows[y]
+            for y in range(1, ROWS+1))
+        empty_chars = array.array('B', bytes(width))
+        empty_attrs = array.array('Q', bytes(width * 8))
+        empty_tiles = array.array('i', (EMPTY_TILE,)) * width if self.use_tile_data else None
+        all_columns = 0
+        for (y, mask, tile_mask) in changed:
+            if (char_rows[y] | tile_rows[y]) & ~rect_mask:
+                change = self._hash_cells(y, char_rows[y] & rect_mask, tile_mask)
+            else:
+                change = row_hashes[y]
+            row_hashes[y] ^= change
+            self.content_hash ^= change
+            if tiles_left and tile_mask:
+                self._unindex_tiles(y, tile_mask)
+            char_rows[y] &= ~rect_mask
+            dirty_rows[y] |= mask
+            all_columns |= mask
+            start = y*STRIDE + start_x
+            self.chars[start:start+width] = empty_chars
+            self.attrs[start:start+width] = empty_attrs
+            if empty_tiles is not None:
+                tile_rows[y] &= ~rect_mask
+                self.tile_nums[start:start+width] = empty_tiles
+                self.tile_flags[start:start+width] = empty_tiles
+        if self._tile_index is not None and not tiles_left:
+            self._tile_index = dict()
+        self._extend_dirty((all_columns & -all_columns).bit_length() - 1,
+                           all_columns.bit_length() - 1, changed[0][0], changed[-1][0])
+        return changed
+
+    def write_run(self, x, y, chars, bitmap, clear_tiles=False): # pylint: disable=too-many-locals
+        """Write the chars (a bytes-like object) starting at the given coordinates
+           with the same attribute bitmap for all of them. Marks any characters
+           that change dirty. The run must fit in the row. Returns (mask, tile_mask),
+           bitmasks with bit x set for each changed column and for each column
+           whose tiledata was cleared.
+           clear_tiles - if True also clear the tiledata under the run"""
+        length = len(chars)
+        row = y*STRIDE
+        start = row + x
+        end = start + length
+        tile_mask = 0
+        if clear_tiles:
+            tile_mask = self.tile_rows[y] & (((1 << length) - 1) << x)
+            if tile_mask:
+                self.make_writable()
+                change = self._hash_cells(y, 0, tile_mask)
+                self.row_hashes[y] ^= change
+                self.content_hash ^= change
+                if self._tile_index is not None:
+                    self._unindex_tiles(y, tile_mask)
+                self.tile_rows[y] &= ~tile_mask
+                empty_tiles = array.array('i', (EMPTY_TILE,)) * length
+                self.tile_nums[start:end] = empty_tiles
+                self.tile_flags[start:end] = empty_tiles
+                self.dirty_rows[y] |= tile_mask
+                self._extend_dirty((tile_mask & -tile_mask).bit_length() - 1,
+                                   tile_mask.bit_length() - 1, y, y)
+        old_chars = self.chars[start:end]
+        new_chars = array.array('B', chars)
+        attrs = self.attrs
+        if old_chars == new_chars and attrs[start:end].count(bitmap) == length:
+            return (0, tile_mask)
+        mask = 0
+        emptied = 0
+        change = 0
+        for (i, old, new) in zip(range(start, end), old_chars, new_chars):
+            old_bitmap = attrs[i]
+            if old != new or old_bitmap != bitmap:
+                mask |= 1 << (i - row)
+                # _cell_hash inlined, this is the parser's hot loop
+                if old or old_bitmap:
+                    change ^= hash((i, old, old_bitmap))
+                if new or bitmap:
+                    change ^= hash((i, new, bitmap))
+                else:
+                    emptied |= 1 << (i - row)
+        self.make_writable()
+        self.content_hash ^= change
+        self.row_hashes[y] ^= change
+        self.char_rows[y] = (self.char_rows[y] | mask) & ~emptied
+        self.dirty_rows[y] |= mask
+        self._extend_dirty((mask & -mask).bit_length() - 1, mask.bit_length() - 1, y, y)
+        self.chars[start:end] = new_chars
+        self.attrs[start:end] = array.array('Q', (bitmap,)) * length
+        return (mask, tile_mask)
+
+class ScreenSnapshot:
+    """The saved state of a ScreenData, see ScreenData.snapshot. Snapshots
+       of the same screen contents, cursor, current window and attributes are
+       equal and hash the same, whatever their dirty flags, so they can be
+       used to deduplicate screens. The hash is the content_hash of the screen
+       at the time of the snapshot."""
+
+    __slots__ = ('windows', 'dirty_states', 'cursor_x', 'cursor_y', 'current_window',
+                 'attributes', '_hash')
+
+    def __init__(self, screen):
+        """Save the state of the screen"""
+        self.windows = tuple(window.snapshot() for window in screen.windows)
+        self.dirty_states = tuple(window.get_dirty_state() for window in screen.windows)
+        self.cursor_x = screen.cursor_x
+        self.cursor_y = screen.cursor_y
+        self.current_window = screen.current_window
+        self.attributes = screen.current_attributes.bitmap
+        self._hash = screen.content_hash()
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, ScreenSnapshot) or self._hash != other._hash:
+            return False
+        return ((self.windows, self.cursor_x, self.cursor_y, self.current_window,
+                 self.attributes) ==
+                (other.windows, other.cursor_x, other.cursor_y, other.current_window,
+                 other.attributes))
+
+class ScreenData: # pylint: disable=too-many-instance-attributes
     """Track all data that makes up the nethack screen. This includes
        character data layered into multiple windows, the current position
        of the cursor, the current active window, and the current attributes
-       set for new characters."""
+       set for new characters.
 
-    def __init__(self):
-        """All windows are initialized empty, with the cursor set to 1,1 in the base window."""
+       Changes are also recorded as a stream of EVENT_* tuples, batched into
+       frames that end at each end_frame call (nethack's end-of-data escape).
+       Use iter_frames to consume them."""
+
+    def __init__(self, record_events=True):
+        """All windows are initialized empty, with the cursor set to 1,1 in the base window.
+           record_events - if False don't record change events"""
         self.windows = list()
         for win in range(MAX_WINDOWS):
             self.windows.append(WindowData(use_tile_data=(win == MAP_WINDOW)))
@@ -243,6 +833,36 @@ class ScreenData:
         self.current_window = BASE_WINDOW
         self.cursor_x = 1
         self.cursor_y = 1
+        # events of the frame in progress, None if not recording
+        self.pending_events = list() if record_events else None
+        self.frames = collections.deque(maxlen=MAX_PENDING_FRAMES)
+        self._frame_cursor = (1, 1)
+
+    def snapshot(self):
+        """Return a ScreenSnapshot of the screen to restore later. This is O(1) in
+           the size of the screen, the windows share their arrays with the snapshot
+           and only copy them when they next change."""
+        return ScreenSnapshot(self)
+
+    def content_hash(self):
+        """Return a hash of the screen contents, cursor, current window and
+           attributes. This is O(1), it combines the content_hash kept by each window."""
+        return hash((tuple(window.content_hash for window in self.windows),
+                     self.cursor_x, self.cursor_y, self.current_window,
+                     self.current_attributes.bitmap))
+
+    def restore(self, snapshot):
+        """Set the screen back to the state saved by snapshot, including the dirty
+           flags. The same snapshot can be restored any number of times. No change
+           events are recorded for the restore."""
+        for (window, window_snapshot, dirty_state) in zip(self.windows, snapshot.windows,
+                                                           snapshot.dirty_states):
+            window.restore(window_snapshot)
+            window.set_dirty_state(dirty_state)
+        self.cursor_x = snapshot.cursor_x
+        self.cursor_y = snapshot.cursor_y
+        self.current_window = snapshot.current_window
+        self.current_attributes.bitmap = snapshot.attributes
 
     def clamp_cursor(self):
         """Enforces edge of screen rules for the cursor by clamping to
@@ -261,9 +881,14 @@ class ScreenData:
         """Return the CharData object at the cursor location in the current window."""
         return self.get_data(self.current_window, self.cursor_x, self.cursor_y)
 
+    def find_tiles(self, num):
+        """Return a set of the (x, y) positions of the given tile number in the
+           map window, see WindowData.tile_positions."""
+        return self.windows[MAP_WINDOW].tile_positions(num)
+
     def get_data(self, window, x, y):
         """Return the CharData from the given window and the given coordinates."""
-        return self.windows[window].char_data[x][y]
+        return self.windows[window].get_data(x, y)
 
     def set_current_dirty(self):
         """Set the character at the cusor location in the current window to be dirty."""
@@ -273,26 +898,81 @@ class ScreenData:
         """Set the character data at the cursor location in the current window to be the
            given char with the current attributes and advance the cursor. If this
            changes the data at the location, mark the character data as dirty."""
-        current_data = self.get_current_data()
-        if (current_data.char != char or
-                self.current_attributes.bitmap != current_data.attributes.bitmap):
-            current_data.char = char
-            self.current_attributes.copy_to(current_data.attributes)
-            self.set_current_dirty()
+        if (self.windows[self.current_window].set_char(self.cursor_x, self.cursor_y, char,
+                                                       self.current_attributes.bitmap) and
+                self.pending_events is not None):
+            self.pending_events.append((EVENT_CELLS_CHANGED, self.current_window,
+                                        self.cursor_x, self.cursor_x, self.cursor_y))
         self.cursor_x += 1
         self.clamp_cursor()
 
+    def write_run(self, chars, clear_tiles=False):
+        """Bulk version of set_char. Write each of the given chars with the current
+           attributes starting at the cursor location in the current window, leaving
+           the cursor after the run. As with set_char, the cursor stops at the right
+           edge so any overflow keeps overwriting the last column.
+           clear_tiles - if True also clear the tiledata under each char written"""
+        room = COLUMNS - self.cursor_x + 1
+        if len(chars) > room:
+            chars = bytes(chars[:room-1]) + bytes(chars[-1:])
+        (mask, tile_mask) = self.windows[self.current_window].write_run(
+            self.cursor_x, self.cursor_y, chars, self.current_attributes.bitmap, clear_tiles)
+        if tile_mask and self.pending_events is not None:
+            self._record_tiles(self.cursor_y, tile_mask)
+        if mask and self.pending_events is not None:
+            for (start_x, end_x) in mask_spans(mask):
+                self.pending_events.append((EVENT_CELLS_CHANGED, self.current_window,
+                                            start_x, end_x, self.cursor_y))
+        self.cursor_x = min(self.cursor_x + len(chars), COLUMNS)
+
     def set_tile(self, num, flag):
         """Set the tiledata at the cursor location to the given tile number and flag.
            This is only valid when the map window is the current window, and should
            not be called when other windows are active. If this call changes the tile
            data at the location, mark the tile/character data as dirty."""
         assert self.current_window == MAP_WINDOW
-        current_data = self.get_current_data()
-        if (current_data.tile_num != num or current_data.tile_flag != flag):
-            current_data.tile_num = num
-            current_data.tile_flag = flag
-            self.set_current_dirty()
+        if (self.windows[MAP_WINDOW].set_tile(self.cursor_x, self.cursor_y, num, flag) and
+                self.pending_events is not None):
+            self.pending_events.append((EVENT_TILE_CHANGED, MAP_WINDOW,
+                                        self.cursor_x, self.cursor_y))
+
+    def clear_tile(self):
+        """Clear the tiledata at the cursor location, as set_tile(None, None).
+           Nethack writing a character outside a tile escape does this."""
+        self.set_tile(None, None)
+
+    def _record_tiles(self, y, tile_mask):
+        """Internal function: record a tile change event for each column of row y
+           of the map window in tile_mask"""
+        for (start_x, end_x) in mask_spans(tile_mask):
+            for x in range(start_x, end_x+1):
+                self.pending_events.append((EVENT_TILE_CHANGED, MAP_WINDOW, x, y))
+
+    def switch_window(self, window):
+        """Make window the current window."""
+        self.current_window = window
+        if self.pending_events is not None:
+            self.pending_events.append((EVENT_WINDOW_SWITCHED, window))
+
+    def end_frame(self):
+        """Nethack has finished sending data. Close the frame of events in progress
+           and queue it for iter_frames."""
+        if self.pending_events is None:
+            return
+        cursor = (self.cursor_x, self.cursor_y)
+        if cursor != self._frame_cursor:
+            self.pending_events.append((EVENT_CURSOR_MOVED,) + cursor)
+            self._frame_cursor = cursor
+        self.pending_events.append((EVENT_END_OF_DATA,))
+        self.frames.append(self.pending_events)
+        self.pending_events = list()
+
+    def iter_frames(self):
+        """Return an iterator that returns each completed frame (a list of events,
+           ending with EVENT_END_OF_DATA) and removes it from the queue. Only the
+           most recent MAX_PENDING_FRAMES are kept if they are not consumed."""
+        while self.frames:
+            yield self.frames.popleft()
 
     def set_all_clean(self):
         """Sets the window data for all windows to be clean."""
@@ -311,24 +991,31 @@ class ScreenData:
            start_y to end_y. all_windows==False(default), current window only.
            all_windows==True, all windows"""
         for win in self._window_range(all_windows):
-            for x in range(1, COLUMNS+1):
-                for y in range(start_y, end_y+1):
-                    if self.get_data(win, x, y).clear():
-                        self.windows[win].set_dirty(x, y)
+            self._record_cleared(win, self.windows[win].clear_rect(1, COLUMNS, start_y, end_y))
 
     def clear_cols(self, start_x, end_x, y, all_windows=False):
         """Clear character data and mark it dirty from
            start_x to end_x in row y. all_windows==False(default), current window only.
            all_windows==True, all windows"""
         for win in self._window_range(all_windows):
-            for x in range(start_x, end_x+1):
-                if self.get_data(win, x, y).clear():
-                    self.windows[win].set_dirty(x, y)
+            self._record_cleared(win, self.windows[win].clear_rect(start_x, end_x, y, y))
+
+    def _record_cleared(self, win, changed):
+        """Internal function: record the change events for the rows of window win
+           changed by clear_rect."""
+        if self.pending_events is None:
+            return
+        for (y, mask, tile_mask) in changed:
+            if tile_mask:
+                self._record_tiles(y, tile_mask)
+            for (start_x, end_x) in mask_spans(mask):
+                self.pending_events.append((EVENT_CELLS_CHANGED, win, start_x, end_x, y))
 
     def enumerate_row(self, win, start_x, end_x, y):
         """Return an iterator that returns a portion of a row"""
+        window = self.windows[win]
         for x in range(start_x, end_x+1):
-            yield self.windows[win].char_data[x][y]
+            yield window.get_data(x, y)
 
     def enumerate_range(self, win, start_x, end_x, start_y, end_y):
         """Return an iterator of iterators the covers the range from
@@ -1,6 +1,7 @@
 """Tests the classes and methods in the screen module."""
 
 import itertools
+import tracemalloc
 import unittest
 
 import screen
@@ -114,6 +115,28 @@ class TestCharAttributes(unittest.TestCase):
         self.assertTrue(self.attributes.check(5))
         self.assertFalse(other.check(5))
 
+    def test_frozen(self):
+        """Test that frozen attributes are interned and immutable."""
+        self.attributes.set(4)
+        frozen = self.attributes.freeze()
+        self.assertIsInstance(frozen, screen.CharAttributes)
+        self.assertEqual([4,], list(frozen.enumerate()))
+        self.assertIs(frozen, screen.frozen_attributes(0x10))
+        self.assertIsNot(frozen, screen.frozen_attributes(0x11))
+
+        # changing the original leaves the frozen one alone
+        self.attributes.set(5)
+        self.assertEqual([4,], list(frozen.enumerate()))
+
+        frozen.copy_to(self.attributes)
+        self.assertEqual([4,], list(self.attributes.enumerate()))
+
+        for func in (lambda: frozen.set(1), lambda: frozen.clear(4), frozen.clear_all,
+                     lambda: setattr(frozen, 'bitmap', 0)):
+            with self.assertRaises(AttributeError):
+                func()
+        self.assertEqual([4,], list(frozen.enumerate()))
+
     def test_clear(self):
         """Test that clearing by bitnumber works."""
         self.assertFalse(self.attributes.check(34))
@@ -302,6 +325,90 @@ class TestScreenData(unittest.TestCase):
         self.assertEqual(21, self.screen.windows[screen.MSG_WINDOW].dirty_y_min)
         self.assertEqual(21, self.screen.windows[screen.MSG_WINDOW].dirty_y_max)
 
+    def test_dirty_spans(self):
+        """Test getting the minimal spans of dirty data from a window."""
+        window = self.screen.windows[screen.MSG_WINDOW]
+        self.assertEqual([], list(window.dirty_spans()))
+
+        self.screen.current_window = screen.MSG_WINDOW
+        self.screen.cursor_x = 1
+        self.screen.cursor_y = 1
+        self.screen.write_run(b'You see here a scroll.')
+        self.screen.cursor_x = 15
+        self.screen.write_run(b'b')
+        self.screen.cursor_x = 80
+        self.screen.set_char(ord(b'!'))
+        self.screen.cursor_x = 3
+        self.screen.cursor_y = 24
+        self.screen.write_run(b'HP:12(12)')
+        self.screen.cursor_x = 7
+        self.screen.write_run(b'1')
+        self.assertEqual([(1, 1, 22), (1, 80, 80), (24, 3, 11)], list(window.dirty_spans()))
+
+        # Only changed characters show up
+        self.screen.set_all_clean()
+        self.assertEqual([0] * (screen.ROWS + 1), window.dirty_rows)
+        self.screen.cursor_x = 3
+        self.screen.write_run(b'HP:10(12)')
+        self.screen.cursor_x = 1
+        self.screen.cursor_y = 1
+        self.screen.write_run(b'You see here a scroll!')
+        self.assertEqual([(1, 15, 15), (1, 22, 22), (24, 7, 7)], list(window.dirty_spans()))
+        self.assertTrue(window.char_data[22][1].dirty)
+        self.assertFalse(window.char_data[21][1].dirty)
+
+    def test_events(self):
+        """Test the stream of change events, batched into frames."""
+        self.assertEqual([], list(self.screen.iter_frames()))
+        self.screen.switch_window(screen.MAP_WINDOW)
+        self.screen.cursor_x = 5
+        self.screen.cursor_y = 4
+        self.screen.set_tile(20, 0)
+        self.screen.set_tile(20, 0) # no change
+        self.screen.set_char(ord(b'@'))
+        self.screen.end_frame()
+
+        self.screen.switch_window(screen.MSG_WINDOW)
+        self.screen.cursor_x = 1
+        self.screen.cursor_y = 1
+        self.screen.write_run(b'Hello')
+        self.screen.cursor_x = 2
+        self.screen.write_run(b'ello!') # only the ! changes
+        self.screen.end_frame()
+
+        self.screen.clear_rows(1, 24, all_windows=True)
+        self.screen.end_frame()
+        self.screen.end_frame()
+
+        self.assertEqual([[(screen.EVENT_WINDOW_SWITCHED, screen.MAP_WINDOW),
+                           (screen.EVENT_TILE_CHANGED, screen.MAP_WINDOW, 5, 4),
+                           (screen.EVENT_CELLS_CHANGED, screen.MAP_WINDOW, 5, 5, 4),
+                           (screen.EVENT_CURSOR_MOVED, 6, 4),
+                           (screen.EVENT_END_OF_DATA,)],
+                          [(screen.EVENT_WINDOW_SWITCHED, screen.MSG_WINDOW),
+                           (screen.EVENT_CELLS_CHANGED, screen.MSG_WINDOW, 1, 5, 1),
+                           (screen.EVENT_CELLS_CHANGED, screen.MSG_WINDOW, 6, 6, 1),
+                           (screen.EVENT_CURSOR_MOVED, 7, 1),
+                           (screen.EVENT_END_OF_DATA,)],
+                          [(screen.EVENT_CELLS_CHANGED, screen.MSG_WINDOW, 1, 6, 1),
+                           (screen.EVENT_TILE_CHANGED, screen.MAP_WINDOW, 5, 4),
+                           (screen.EVENT_CELLS_CHANGED, screen.MAP_WINDOW, 5, 5, 4),
+                           (screen.EVENT_END_OF_DATA,)],
+                          [(screen.EVENT_END_OF_DATA,)]],
+                         list(self.screen.iter_frames()))
+        self.assertEqual([], list(self.screen.iter_frames()))
+
+        # Old frames are dropped if nobody consumes them
+        for _ in range(screen.MAX_PENDING_FRAMES + 5):
+            self.screen.end_frame()
+        self.assertEqual(screen.MAX_PENDING_FRAMES, len(list(self.screen.iter_frames())))
+
+        # Recording can be turned off
+        screen_ = screen.ScreenData(record_events=False)
+        screen_.set_char(ord(b'a'))
+        screen_.end_frame()
+        self.assertEqual([], list(screen_.iter_frames()))
+
     def test_screen_attrs(self):
         """Test the attributes set into the screen current_attributes are transfer
            into any written characters. And the subsequent changes to current_attributes
@@ -333,6 +440,95 @@ class TestScreenData(unittest.TestCase):
         self.assertEqual(g.char, ord(b'g'))
         self.assertEqual(list(g.attributes.enumerate()), [])
 
+    def test_write_run(self):
+        """Test the bulk write matches set_char, including the right edge."""
+        self.screen.cursor_x = 75
+        self.screen.cursor_y = 3
+        self.screen.current_attributes.set(4)
+        self.screen.write_run(b'abcdefgh')
+        self.assertEqual(80, self.screen.cursor_x)
+        self.assertEqual(b'abcdeh',
+                         bytes([data.char for data in
+                                self.screen.enumerate_row(screen.BASE_WINDOW, 75, 80, 3)]))
+        self.assertEqual(None, self.screen.get_data(screen.BASE_WINDOW, 74, 3).char)
+        self.assertEqual([4,], list(self.screen.get_data(screen.BASE_WINDOW, 80, 3)
+                                    .attributes.enumerate()))
+        window = self.screen.windows[screen.BASE_WINDOW]
+        self.assertEqual((75, 80, 3, 3), (window.dirty_x_min, window.dirty_x_max,
+                                          window.dirty_y_min, window.dirty_y_max))
+
+        # writing the same data again changes nothing
+        self.screen.set_all_clean()
+        self.screen.cursor_x = 75
+        self.screen.write_run(b'abcdeh')
+        self.assertFalse(window.has_dirty_data())
+
+    def test_clear_rect(self):
+        """Test clearing a rectangle of a window, including cells that only have
+           tiledata, and that only changed cells get marked dirty."""
+        window = self.screen.windows[screen.MAP_WINDOW]
+        self.screen.current_window = screen.MAP_WINDOW
+        self.screen.cursor_x = 10
+        self.screen.cursor_y = 5
+        self.screen.set_tile(99, 1)
+        self.screen.cursor_x = 30
+        self.screen.cursor_y = 7
+        self.screen.write_run(b'xyz')
+        self.screen.cursor_x = 60
+        self.screen.cursor_y = 20
+        self.screen.set_char(ord(b'!'))
+        self.screen.set_all_clean()
+
+        window.clear_rect(5, 31, 2, 8)
+        self.assertEqual((10, 31, 5, 7), (window.dirty_x_min, window.dirty_x_max,
+                                          window.dirty_y_min, window.dirty_y_max))
+        self.assertEqual([(10, 5), (30, 7), (31, 7)],
+                         [(x, y) for y in range(1, screen.ROWS+1)
+                          for x in range(1, screen.COLUMNS+1) if window.char_data[x][y].dirty])
+        self.assertEqual(None, window.char_data[10][5].tile_num)
+        self.assertEqual(None, window.char_data[30][7].char)
+        self.assertEqual(ord(b'z'), window.char_data[32][7].char)
+        self.assertEqual(ord(b'!'), window.char_data[60][20].char)
+
+        # Clearing again changes nothing
+        self.screen.set_all_clean()
+        window.clear_rect(5, 31, 2, 8)
+        self.assertFalse(window.has_dirty_data())
+
+    def test_storage_views(self):
+        """Test the CharData/TileData views read and write the window arrays."""
+        window = self.screen.windows[screen.MAP_WINDOW]
+        data = window.char_data[7][3]
+        self.assertIsInstance(data, screen.TileData)
+        self.assertIsInstance(self.screen.get_data(screen.MSG_WINDOW, 7, 3), screen.CharData)
+        self.assertEqual((None, 0, None, None, False),
+                         (data.char, data.attributes.bitmap, data.tile_num, data.tile_flag,
+                          data.dirty))
+
+        self.screen.current_window = screen.MAP_WINDOW
+        self.screen.cursor_x = 7
+        self.screen.cursor_y = 3
+        self.screen.set_tile(1234, 0)
+        self.screen.current_attributes.set(screen.ATTR_RED_FG)
+        self.screen.set_char(ord(b'@'))
+        self.assertEqual((ord(b'@'), 1 << screen.ATTR_RED_FG, 1234, 0, True),
+                         (data.char, data.attributes.bitmap, data.tile_num, data.tile_flag,
+                          data.dirty))
+        index = 3 * screen.STRIDE + 7
+        self.assertEqual((ord(b'@'), 1 << screen.ATTR_RED_FG, 1234, 0, 1 << 7),
+                         (window.chars[index], window.attrs[index], window.tile_nums[index],
+                          window.tile_flags[index], window.dirty_rows[3]))
+
+        attributes = screen.CharAttributes()
+        attributes.set(screen.ATTR_BOLD)
+        data.attributes = attributes
+        self.assertTrue(window.char_data[7][3].attributes.check(screen.ATTR_BOLD))
+        self.assertIs(attributes.freeze(), data.attributes)
+        self.assertTrue(data.clear())
+        self.assertFalse(data.clear())
+        self.assertEqual((None, 0, None, None),
+                         (data.char, data.attributes.bitmap, data.tile_num, data.tile_flag))
+
     def test_clear(self):
         """Test the ScreenData functions that clear data"""
         self.screen.cursor_x = 5
@@ -361,5 +557,180 @@ class TestScreenData(unittest.TestCase):
             for data, byte in zip(rng, row_list):
                 self.assertEqual(data.char, None if byte is None else ord(byte))
 
+    def test_snapshot(self):
+        """Test snapshot/restore, that windows are only copied when they change
+           and that snapshots of the same screen are equal."""
+        self.screen.current_window = screen.MAP_WINDOW
+        self.screen.cursor_x = 10
+        self.screen.cursor_y = 5
+        self.screen.set_tile(42, 0)
+        self.screen.write_run(b'@')
+        saved = self.screen.snapshot()
+        again = self.screen.snapshot()
+        self.assertEqual(saved, again)
+        self.assertEqual(hash(saved), hash(again))
+        self.assertEqual(1, len({saved, again}))
+        map_chars = self.screen.windows[screen.MAP_WINDOW].chars
+        base_chars = self.screen.windows[screen.BASE_WINDOW].chars
+
+        # only the changed window is copied
+        self.screen.cursor_x = 10
+        self.screen.write_run(b'd', clear_tiles=True)
+        self.screen.set_all_clean()
+        self.assertIsNot(map_chars, self.screen.windows[screen.MAP_WINDOW].chars)
+        self.assertIs(base_chars, self.screen.windows[screen.BASE_WINDOW].chars)
+        changed = self.screen.snapshot()
+        self.assertNotEqual(saved, changed)
+        data = self.screen.get_data(screen.MAP_WINDOW, 10, 5)
+        self.assertEqual((ord(b'd'), None), (data.char, data.tile_num))
+
+        self.screen.restore(saved)
+        self.assertEqual((ord(b'@'), 42, True), (data.char, data.tile_num, data.dirty))
+        self.assertEqual((11, 5), (self.screen.cursor_x, self.screen.cursor_y))
+        self.assertEqual(saved, self.screen.snapshot())
+
+        # changes through the views don't reach the snapshot either
+        data.char = ord(b'x')
+        self.assertTrue(data.clear())
+        self.screen.restore(saved)
+        self.assertEqual((ord(b'@'), 42), (data.char, data.tile_num))
+        self.screen.restore(changed)
+        self.assertEqual((ord(b'd'), None, False), (data.char, data.tile_num, data.dirty))
+
+        # the dirty flags don't affect equality
+        self.screen.windows[screen.BASE_WINDOW].set_dirty(1, 1)
+        self.assertEqual(changed, self.screen.snapshot())
+
+    def test_content_hash(self):
+        """Test the incrementally kept hash matches the window contents."""
+        def full_hash(window):
+            """The hash computed from scratch, checking the per row hashes and
+               masks of non-empty cells on the way"""
+            result = 0
+            for y in range(screen.ROWS+1):
+                (row_hash, char_mask, tile_mask) = (0, 0, 0)
+                for i in range(y*screen.STRIDE, (y+1)*screen.STRIDE):
+                    if window.chars[i] or window.attrs[i]:
+                        row_hash ^= hash((i, window.chars[i], window.attrs[i]))
+                        char_mask |= 1 << (i - y*screen.STRIDE)
+                    if window.use_tile_data and (window.tile_nums[i] != screen.EMPTY_TILE or
+                                                 window.tile_flags[i] != screen.EMPTY_TILE):
+                        row_hash ^= hash((-i, window.tile_nums[i], window.tile_flags[i]))
+                        tile_mask |= 1 << (i - y*screen.STRIDE)
+                self.assertEqual((row_hash, char_mask, tile_mask),
+                                 (window.row_hashes[y], window.char_rows[y],
+                                  window.tile_rows[y]), y)
+                result ^= row_hash
+            return result
+
+        empty_hash = self.screen.content_hash()
+        window = self.screen.windows[screen.MAP_WINDOW]
+        self.screen.current_window = screen.MAP_WINDOW
+        self.screen.cursor_y = 4
+        for x in range(1, 30, 3):
+            self.screen.cursor_x = x
+            self.screen.set_tile(1000 + x, x % 2)
+        self.screen.cursor_x = 5
+        self.screen.current_attributes.set(screen.ATTR_BOLD)
+        self.screen.write_run(b'kobold')
+        self.screen.set_char(ord(b'!'))
+        self.assertEqual(full_hash(window), window.content_hash)
+        self.assertNotEqual(empty_hash, self.screen.content_hash())
+
+        data = window.char_data[20][4]
+        data.char = ord(b'x')
+        data.tile_flag = 5
+        self.assertEqual(full_hash(window), window.content_hash)
+        self.screen.cursor_x = 1
+        self.screen.write_run(b'abcdefgh', clear_tiles=True)
+        self.assertEqual(full_hash(window), window.content_hash)
+        self.screen.clear_cols(3, 21, 4)
+        self.assertEqual(full_hash(window), window.content_hash)
+        self.assertEqual(hash(self.screen.snapshot()), self.screen.content_hash())
+
+        # the rows are saved and restored with the rest of the window
+        saved = self.screen.snapshot()
+        self.screen.clear_rows(4, 4)
+        self.assertEqual(full_hash(window), window.content_hash)
+        self.screen.restore(saved)
+        self.assertEqual(full_hash(window), window.content_hash)
+        data.attributes = screen.CharAttributes()
+        data.char = None
+        self.assertEqual(full_hash(window), window.content_hash)
+
+        # back to empty gives back the empty hash
+        self.screen.clear_rows(1, screen.ROWS, all_windows=True)
+        self.screen.current_window = screen.BASE_WINDOW
+        self.screen.cursor_x = 1
+        self.screen.cursor_y = 1
+        self.screen.current_attributes.clear_all()
+        self.assertEqual((0, empty_hash), (window.content_hash, self.screen.content_hash()))
+
+    def test_find_tiles(self):
+        """Test the tile index follows every way of changing the tiles."""
+        window = self.screen.windows[screen.MAP_WINDOW]
+
+        def scan(num):
+            """The positions of the tile found the slow way"""
+            return {(x, y) for y in range(1, screen.ROWS+1) for x in range(1, screen.COLUMNS+1)
+                    if window.char_data[x][y].tile_num == num}
+
+        self.screen.current_window = screen.MAP_WINDOW
+        for (x, y, num) in ((3, 4, 10), (5, 4, 10), (7, 4, 11), (3, 9, 10), (9, 9, 12)):
+            self.screen.cursor_x = x
+            self.screen.cursor_y = y
+            self.screen.set_tile(num, 0)
+        self.assertEqual({(3, 4), (5, 4), (3, 9)}, self.screen.find_tiles(10))
+        self.assertEqual(set(), self.screen.find_tiles(99))
+        saved = self.screen.snapshot()
+
+        # replacing a tile moves it to the new number
+        self.screen.cursor_x = 5
+        self.screen.cursor_y = 4
+        self.screen.set_tile(11, 0)
+        window.char_data[9][9].tile_num = 10
+        self.assertTrue(window.char_data[3][9].clear_tile())
+        self.screen.cursor_x = 6
+        self.screen.write_run(b'ab', clear_tiles=True)
+        self.screen.clear_cols(1, 3, 4)
+        for num in (10, 11, 12):
+            self.assertEqual(scan(num), self.screen.find_tiles(num), num)
+        self.assertEqual({(5, 4)}, self.screen.find_tiles(11))
+
+        # the index is rebuilt after a restore
+        self.screen.restore(saved)
+        self.assertEqual({(3, 4), (5, 4), (3, 9)}, self.screen.find_tiles(10))
+        self.screen.clear_rows(1, screen.ROWS)
+        self.assertEqual(set(), self.screen.find_tiles(10))
+        self.assertEqual(set(), self.screen.windows[screen.BASE_WINDOW].tile_positions(10))
+
+class TestMemory(unittest.TestCase):
+    """Regression tests for the memory used by the screen data."""
+
+    # bytes allowed for one ScreenData, the window arrays take about 180KB
+    SCREEN_DATA_BYTE_BUDGET = 256 * 1024
+
+    def test_screen_data_budget(self):
+        """A new ScreenData must stay within the byte budget."""
+        tracemalloc.start()
+        try:
+            screen_ = screen.ScreenData()
+            (_, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertIsNotNone(screen_)
+        self.assertLess(peak, self.SCREEN_DATA_BYTE_BUDGET)
+
+    def test_slots(self):
+        """The per-character classes must not grow a __dict__."""
+        screen_ = screen.ScreenData()
+        for obj in (screen.CharAttributes(),
+                    screen_.current_attributes,
+                    screen_.get_data(screen.BASE_WINDOW, 1, 1),
+                    screen_.get_data(screen.MAP_WINDOW, 1, 1),
+                    screen_.get_data(screen.MAP_WINDOW, 1, 1).attributes,
+                    screen_.windows[screen.BASE_WINDOW].char_data[1]):
+            self.assertFalse(hasattr(obj, '__dict__'), type(obj).__name__)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,15 +1,74 @@
 """Classes to represent the various ways of running nethack, mostly either
-   a local subprocess or (TODO) a remote ssh connection."""
+   a local subprocess or (TODO) a remote ssh connection. Sessions can also
+   be recorded to a log and replayed without nethack."""
 
+import asyncio
+import errno
+import os
 import os.path
 import pty
 import select
+import struct
 import subprocess
+import time
 
 def default_subprocess():
     """Run a local copy of nethack from the default install location"""
     return SubprocessNethack(SubprocessNethack.DEFAULT_NH)
 
+def default_async_subprocess():
+    """Run a local copy of nethack from the default install location, for asyncio"""
+    return AsyncSubprocessNethack(SubprocessNethack.DEFAULT_NH)
+
+# Initial and largest sizes of the reusable read buffers
+MIN_READ_SIZE = 4096
+MAX_READ_SIZE = 1 << 20
+
+class ReadBuffer:
+    """A reusable buffer to read into, which doubles in size (up to MAX_READ_SIZE)
+       whenever a read fills it, so big redraws take fewer reads."""
+
+    def __init__(self):
+        """Start at MIN_READ_SIZE"""
+        self.buffer = bytearray(MIN_READ_SIZE)
+
+    def view(self, count):
+        """Return a memoryview of the first count bytes just read into buffer.
+           It is only valid until the buffer is read into again."""
+        view = memoryview(self.buffer)[:count]
+        if len(self.buffer) == count < MAX_READ_SIZE:
+            # replace rather than resize, the old buffer is still exported by view
+            self.buffer = bytearray(count * 2)
+        return view
+
+def read_frame(nethack, parser_, timeout=1.0, tiledata_timeout=30.0):
+    """Read from nethack and parse the output until a whole frame has been
+       parsed, returning True as soon as the parser sees the vt_tiledata
+       end-of-data escape. Until the parser has seen any tiledata there is no
+       way to know when nethack is done, so instead give up, end the frame
+       (see Parser.end_frame) and return False once no data arrives for
+       timeout seconds. After that tiledata_timeout is only a safety net in
+       case nethack stops responding."""
+    while True:
+        data = nethack.read_view(tiledata_timeout if parser_.seen_tiledata else timeout)
+        if not data:
+            parser_.end_frame()
+            return False
+        parser_.parse_bytes(data)
+        if parser_.end_of_data:
+            return True
+
+async def read_frame_async(nethack, parser_, timeout=1.0, tiledata_timeout=30.0):
+    """Version of read_frame for AsyncSubprocessNethack."""
+    while True:
+        data = await nethack.read_view(tiledata_timeout if parser_.seen_tiledata else timeout)
+        if not data:
+            parser_.end_frame()
+            return False
+        parser_.parse_bytes(data)
+        if parser_.end_of_data:
+            return True
+
 class SubprocessNethack:
     """Represents interacting with nethack running in a local subprocess"""
 
@@ -19,20 +78,41 @@ class SubprocessNethack:
         """Run a nethack subprocess using the given command"""
         (parent_pty, child_pty) = pty.openpty()
         self.io_pty = open(parent_pty, 'br+', buffering=0)
-        self.subproc = subprocess.Popen(args,
-                                        stdin=child_pty,
-                                        stdout=child_pty,
-                                        bufsize=0, # unbuffered
-                                        close_fds=True)
+        self.read_buffer = ReadBuffer()
+        try:
+            self.subproc = subprocess.Popen(args,
+                                            stdin=child_pty,
+                                            stdout=child_pty,
+                                            bufsize=0, # unbuffered
+                                            close_fds=True)
+        except OSError:
+            self.io_pty.close()
+            raise
+        finally:
+            # Only the child should hold its end, so reads see EOF when it exits
+            os.close(child_pty)
 
     def read(self, timeout=1.0):
         """Read data from nethack stdout if available, or if no data is
-           available by the given timeout, return None"""
+           available by the given timeout, return None. Returns b'' once
+           nethack has exited."""
+        view = self.read_view(timeout)
+        return None if view is None else bytes(view)
+
+    def read_view(self, timeout=1.0):
+        """Same as read, but without copying. Returns a memoryview of the data
+           in the read buffer, which is only valid until the next read."""
         (readable, _, _) = select.select((self.io_pty,), (), (),
                                          timeout)
-        if readable:
-            return self.io_pty.read(1024)
-        return None
+        if not readable:
+            return None
+        try:
+            return self.read_buffer.view(self.io_pty.readinto(self.read_buffer.buffer))
+        except OSError as exc:
+            # Linux reports the other end of the pty closing as EIO
+            if exc.errno == errno.EIO:
+                return self.read_buffer.view(0)
+            raise
 
     def write(self, bytes_):
         """Write data to nethack stdin"""
@@ -44,3 +124,261 @@ class SubprocessNethack:
         self.io_pty.close()
         self.subproc.terminate()
         self.subproc.communicate()
+
+class AsyncSubprocessNethack:
+    """Represents interacting with nethack running in a local subprocess from
+       asyncio. The pty is non-blocking and registered with the running event
+       loop only while waiting on it, so a single thread can drive many games.
+       Iterating with async for returns each chunk of output until nethack exits."""
+
+    def __init__(self, *args):
+        """Run a nethack subprocess using the given command"""
+        (parent_pty, child_pty) = pty.openpty()
+        self.subproc = subprocess.Popen(args,
+                                        stdin=child_pty,
+                                        stdout=child_pty,
+                                        bufsize=0, # unbuffered
+                                        close_fds=True)
+        # Only the child should hold its end, so reads see EOF when it exits
+        os.close(child_pty)
+        os.set_blocking(parent_pty, False)
+        self.pty_fd = parent_pty
+        self.write_buffer = bytearray()
+        self.read_buffer = ReadBuffer()
+
+    async def _wait_fd(self, add_func, remove_func):
+        """Internal function: wait for the pty to be ready, using add_func/remove_func
+           to register with the event loop (add_reader/remove_reader, etc.)"""
+        future = asyncio.get_running_loop().create_future()
+        def ready():
+            if not future.done():
+                future.set_result(None)
+        add_func(self.pty_fd, ready)
+        try:
+            await future
+        finally:
+            remove_func(self.pty_fd)
+
+    async def _read(self):
+        """Internal function: read into the read buffer without a timeout,
+           returns a memoryview that is empty at EOF"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return self.read_buffer.view(os.readv(self.pty_fd, (self.read_buffer.buffer,)))
+            except BlockingIOError:
+                await self._wait_fd(loop.add_reader, loop.remove_reader)
+            except OSError as exc:
+                # Linux reports the other end of the pty closing as EIO
+                if exc.errno == errno.EIO:
+                    return self.read_buffer.view(0)
+                raise
+
+    async def read(self, timeout=None):
+        """Read data from nethack stdout when available. If no data is available
+           by the given timeout (seconds, None to wait forever) return None.
+           Returns b'' once nethack has exited."""
+        view = await self.read_view(timeout)
+        return None if view is None else bytes(view)
+
+    async def read_view(self, timeout=None):
+        """Same as read, but without copying. Returns a memoryview of the data
+           in the read buffer, which is only valid until the next read."""
+        if timeout is None:
+            return await self._read()
+        try:
+            return await asyncio.wait_for(self._read(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def write(self, bytes_):
+        """Write data to nethack stdin. As much as possible is written immediately,
+           the rest is buffered until drain is awaited."""
+        self.write_buffer += bytes_
+        self._flush()
+
+    def _flush(self):
+        """Internal function: write as much of the write buffer as the pty takes
+           without blocking. Returns True if the buffer is empty."""
+        while self.write_buffer:
+            try:
+                written = os.write(self.pty_fd, self.write_buffer)
+            except BlockingIOError:
+                return False
+            del self.write_buffer[:written]
+        return True
+
+    async def drain(self):
+        """Wait until all written data has been passed to nethack."""
+        loop = asyncio.get_running_loop()
+        while not self._flush():
+            await self._wait_fd(loop.add_writer, loop.remove_writer)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self._read()
+        if not data:
+            raise StopAsyncIteration
+        return bytes(data)
+
+    def terminate(self):
+        """Immediately terminate the nethack subprocess with SIGTERM. This
+           is intended to be used from tests."""
+        os.close(self.pty_fd)
+        self.subproc.terminate()
+        self.subproc.communicate()
+
+# Session log format. The file starts with LOG_MAGIC, then for each chunk
+# a LOG_RECORD header (direction, seconds since the start, length) followed
+# by the data. Closing the log appends an index: the offset of every record
+# as LOG_OFFSET, then a LOG_FOOTER (index offset, record count, INDEX_MAGIC).
+LOG_MAGIC = b'JOTLOG1\n'
+INDEX_MAGIC = b'JOTIDX1\n'
+LOG_RECORD = struct.Struct('<BdI')
+LOG_OFFSET = struct.Struct('<Q')
+LOG_FOOTER = struct.Struct('<QQ8s')
+
+# Directions of the records in a session log
+LOG_READ = 1 # data read from nethack
+LOG_WRITE = 2 # data written to nethack
+
+class SessionLogWriter:
+    """Writes a session log to a file."""
+
+    def __init__(self, path):
+        """Create (or truncate) the log file at path"""
+        self.file = open(path, 'wb')
+        self.file.write(LOG_MAGIC)
+        self.offsets = list()
+        self.start = time.monotonic()
+
+    def record(self, direction, data):
+        """Append a record of data going in the given direction (LOG_READ/LOG_WRITE)"""
+        self.offsets.append(self.file.tell())
+        self.file.write(LOG_RECORD.pack(direction, time.monotonic() - self.start, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        """Write the index and close the file"""
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        for offset in self.offsets:
+            self.file.write(LOG_OFFSET.pack(offset))
+        self.file.write(LOG_FOOTER.pack(index_offset, len(self.offsets), INDEX_MAGIC))
+        self.file.close()
+
+class SessionLog:
+    """A session log read into memory. Indexing returns the records as
+       (direction, timestamp, data) tuples, data is a memoryview."""
+
+    def __init__(self, path):
+        """Read the log file at path. A log that was never closed has no
+           index, in which case the records are found by scanning."""
+        with open(path, 'rb') as file_:
+            self.data = memoryview(file_.read())
+        if bytes(self.data[:len(LOG_MAGIC)]) != LOG_MAGIC:
+            raise ValueError('Not a session log: '+str(path))
+        self.offsets = self._read_index()
+        if self.offsets is None:
+            self.offsets = self._scan()
+
+    def _read_index(self):
+        """Internal function: return the record offsets from the index, or None"""
+        if len(self.data) < len(LOG_MAGIC) + LOG_FOOTER.size:
+            return None
+        (index_offset, count, magic) = LOG_FOOTER.unpack_from(self.data,
+                                                              len(self.data) - LOG_FOOTER.size)
+        if magic != INDEX_MAGIC:
+            return None
+        return [offset for (offset,) in
+                LOG_OFFSET.iter_unpack(self.data[index_offset:index_offset +
+                                                 count * LOG_OFFSET.size])]
+
+    def _scan(self):
+        """Internal function: return the offsets of all complete records"""
+        offsets = list()
+        offset = len(LOG_MAGIC)
+        while offset + LOG_RECORD.size <= len(self.data):
+            (_, _, length) = LOG_RECORD.unpack_from(self.data, offset)
+            if offset + LOG_RECORD.size + length > len(self.data):
+                break
+            offsets.append(offset)
+            offset += LOG_RECORD.size + length
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, num):
+        offset = self.offsets[num]
+        (direction, timestamp, length) = LOG_RECORD.unpack_from(self.data, offset)
+        start = offset + LOG_RECORD.size
+        return (direction, timestamp, self.data[start:start+length])
+
+class RecordingNethack:
+    """Wraps another (non-asyncio) nethack server, passing everything through
+       while recording every chunk read and written to a session log."""
+
+    def __init__(self, nethack, path):
+        """Record the traffic of nethack to the log file at path"""
+        self.nethack = nethack
+        self.log = SessionLogWriter(path)
+
+    def read(self, timeout=1.0):
+        """Read from the wrapped server, see SubprocessNethack.read"""
+        view = self.read_view(timeout)
+        return None if view is None else bytes(view)
+
+    def read_view(self, timeout=1.0):
+        """Read from the wrapped server, see SubprocessNethack.read_view"""
+        view = self.nethack.read_view(timeout)
+        if view:
+            self.log.record(LOG_READ, view)
+        return view
+
+    def write(self, bytes_):
+        """Write to the wrapped server"""
+        self.log.record(LOG_WRITE, bytes_)
+        self.nethack.write(bytes_)
+
+    def terminate(self):
+        """Close the log and terminate the wrapped server"""
+        self.log.close()
+        self.nethack.terminate()
+
+class ReplayNethack:
+    """Plays back the data read in a session log at full speed, with the same
+       interface as SubprocessNethack. Writes are accepted and ignored, once the
+       log runs out reads return None as though nethack went idle."""
+
+    def __init__(self, path):
+        """Replay the session log at path"""
+        self.log = SessionLog(path)
+        self.position = 0
+
+    def read(self, timeout=1.0):
+        """Return the next chunk read in the session, or None at the end"""
+        view = self.read_view(timeout)
+        return None if view is None else bytes(view)
+
+    def read_view(self, timeout=1.0): # pylint: disable=unused-argument
+        """Same as read, but returns a memoryview into the log"""
+        while self.position < len(self.log):
+            (direction, _, data) = self.log[self.position]
+            self.position += 1
+            if direction == LOG_READ:
+                return data
+        return None
+
+    def write(self, bytes_):
+        """Ignored, the replay doesn't depend on the input"""
+
+    def rewind(self):
+        """Start the replay again from the beginning"""
+        self.position = 0
+
+    def terminate(self):
+        """Nothing to terminate, provided to match SubprocessNethack"""
@@ -1,9 +1,14 @@
 """unittests for the server module"""
 
+import asyncio
 import os
+import sys
+import tempfile
+import time
 import unittest
 
 import parser
+import screen
 import server
 
 class TestDefaultSubprocess(unittest.TestCase):
@@ -101,5 +106,222 @@ class TestDefaultSubprocess(unittest.TestCase):
         parse_loop()
         #print(output)
 
+
+# Stand-ins for nethack that write one frame and then go quiet
+FRAME_SCRIPT = ('import sys, time; sys.stdout.write("abc\\x1b[1;3z"); sys.stdout.flush(); '
+                'time.sleep(10)')
+BIG_FRAME_SCRIPT = ('import sys, time; sys.stdout.write(("x" * 79 + "\\n") * 200 + "x\\x1b[1;3z"); '
+                    'sys.stdout.flush(); time.sleep(10)')
+NO_TILEDATA_SCRIPT = 'import sys, time; sys.stdout.write("abc"); sys.stdout.flush(); time.sleep(10)'
+
+class TestReadBuffer(unittest.TestCase):
+    """Test the reusable read buffer."""
+
+    def test_grow(self):
+        """The buffer is reused until a read fills it, then it doubles."""
+        read_buffer = server.ReadBuffer()
+        buffer = read_buffer.buffer
+        self.assertEqual(server.MIN_READ_SIZE, len(buffer))
+        buffer[:3] = b'abc'
+        view = read_buffer.view(3)
+        self.assertEqual(b'abc', view)
+        self.assertIs(buffer, read_buffer.buffer)
+
+        buffer[:] = b'x' * len(buffer)
+        view = read_buffer.view(len(buffer))
+        self.assertEqual(b'x' * server.MIN_READ_SIZE, view)
+        self.assertEqual(server.MIN_READ_SIZE * 2, len(read_buffer.buffer))
+
+        # stops growing at the max
+        while len(read_buffer.buffer) < server.MAX_READ_SIZE:
+            read_buffer.view(len(read_buffer.buffer))
+        read_buffer.view(len(read_buffer.buffer))
+        self.assertEqual(server.MAX_READ_SIZE, len(read_buffer.buffer))
+
+class TestReadFrame(unittest.TestCase):
+    """Test reading until the end of a frame, with nethack stand-ins."""
+
+    def _read_frame(self, script):
+        """Run the script and return (read_frame result, elapsed time, parser)"""
+        nethack = server.SubprocessNethack(sys.executable, '-c', script)
+        parser_ = parser.Parser()
+        try:
+            start = time.monotonic()
+            result = server.read_frame(nethack, parser_, timeout=0.5)
+            return (result, time.monotonic() - start, parser_)
+        finally:
+            nethack.terminate()
+
+    def test_end_of_data(self):
+        """Return as soon as the end-of-data escape is parsed."""
+        (result, elapsed, parser_) = self._read_frame(FRAME_SCRIPT)
+        self.assertTrue(result)
+        self.assertTrue(parser_.end_of_data)
+        self.assertTrue(parser_.seen_tiledata)
+        self.assertLess(elapsed, 0.5)
+
+    def test_timeout(self):
+        """Without tiledata fall back to the timeout."""
+        (result, elapsed, parser_) = self._read_frame(NO_TILEDATA_SCRIPT)
+        self.assertFalse(result)
+        self.assertFalse(parser_.seen_tiledata)
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertEqual(ord(b'c'), parser_.screen.get_data(screen.BASE_WINDOW, 3, 1).char)
+        # the timeout ends the frame, so the events don't pile up
+        (frame,) = parser_.screen.iter_frames()
+        self.assertEqual((screen.EVENT_END_OF_DATA,), frame[-1])
+        self.assertEqual([], parser_.screen.pending_events)
+
+    def test_big_frame(self):
+        """A frame much bigger than the read buffer takes several reads."""
+        nethack = server.SubprocessNethack(sys.executable, '-c', BIG_FRAME_SCRIPT)
+        parser_ = parser.Parser()
+        try:
+            self.assertTrue(server.read_frame(nethack, parser_, timeout=5.0))
+        finally:
+            nethack.terminate()
+        self.assertEqual(ord(b'x'), parser_.screen.get_data(screen.BASE_WINDOW, 79, 24).char)
+
+    def test_eof(self):
+        """Once the subprocess exits reads return b'' rather than raising."""
+        nethack = server.SubprocessNethack(sys.executable, '-c', 'print("hi")')
+        parser_ = parser.Parser()
+        try:
+            start = time.monotonic()
+            self.assertFalse(server.read_frame(nethack, parser_, timeout=5.0))
+            self.assertLess(time.monotonic() - start, 5.0)
+            self.assertEqual(b'', nethack.read())
+        finally:
+            nethack.terminate()
+        self.assertEqual(ord(b'h'), parser_.screen.get_data(screen.BASE_WINDOW, 1, 1).char)
+
+    def test_async(self):
+        """The asyncio version also returns at the end-of-data escape."""
+        nethack = server.AsyncSubprocessNethack(sys.executable, '-c', FRAME_SCRIPT)
+        parser_ = parser.Parser()
+        try:
+            self.assertTrue(asyncio.run(server.read_frame_async(nethack, parser_, timeout=5.0)))
+        finally:
+            nethack.terminate()
+
+class TestRecordReplay(unittest.TestCase):
+    """Test recording a session and replaying it."""
+
+    def setUp(self):
+        """The fixture is a temporary directory for the logs"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'session.log')
+
+    def tearDown(self):
+        """Remove the logs"""
+        self.tmpdir.cleanup()
+
+    def test_replay(self):
+        """A replay gives the same chunks, and parses to the same screen."""
+        nethack = server.RecordingNethack(
+            server.SubprocessNethack(sys.executable, '-c', BIG_FRAME_SCRIPT), self.path)
+        parser_ = parser.Parser()
+        chunks = list()
+        try:
+            nethack.write(b'hi')
+            while not parser_.end_of_data or not chunks:
+                data = nethack.read(5.0)
+                self.assertTrue(data)
+                chunks.append(data)
+                parser_.parse_bytes(data)
+        finally:
+            nethack.terminate()
+
+        log = server.SessionLog(self.path)
+        self.assertEqual(len(chunks) + 1, len(log))
+        (direction, timestamp, data) = log[0]
+        self.assertEqual((server.LOG_WRITE, b'hi'), (direction, data))
+        self.assertGreaterEqual(timestamp, 0.0)
+
+        replay = server.ReplayNethack(self.path)
+        replay.write(b'hi')
+        self.assertEqual(chunks, [replay.read() for _ in chunks])
+        self.assertIsNone(replay.read())
+
+        replay.rewind()
+        other = parser.Parser()
+        self.assertTrue(server.read_frame(replay, other))
+        for row, other_row in zip(parser_.screen.enumerate_range(screen.BASE_WINDOW, 1, 80, 1, 24),
+                                  other.screen.enumerate_range(screen.BASE_WINDOW, 1, 80, 1, 24)):
+            self.assertEqual([data.char for data in row], [data.char for data in other_row])
+
+    def test_unclosed(self):
+        """A log that was never closed has no index, but can still be read."""
+        writer = server.SessionLogWriter(self.path)
+        writer.record(server.LOG_READ, b'abc')
+        writer.record(server.LOG_WRITE, b'd')
+        writer.record(server.LOG_READ, b'ef')
+        writer.file.write(server.LOG_RECORD.pack(server.LOG_READ, 0.0, 10) + b'partial')
+        writer.file.close()
+
+        replay = server.ReplayNethack(self.path)
+        self.assertEqual([b'abc', b'ef', None], [replay.read() for _ in range(3)])
+
+        with open(self.path, 'wb') as file_:
+            file_.write(b'not a log')
+        with self.assertRaises(ValueError):
+            server.SessionLog(self.path)
+
+# A tiny stand-in for nethack, it upper-cases one line of input then exits
+ECHO_SCRIPT = 'print("ready", flush=True); print(input().upper(), flush=True)'
+
+class TestAsyncSubprocess(unittest.IsolatedAsyncioTestCase):
+    """Test the asyncio based subprocess server. These use a small python
+       script instead of nethack so they only test the transport."""
+
+    def setUp(self):
+        """The fixture is an async subprocess running the echo script."""
+        self.server = server.AsyncSubprocessNethack(sys.executable, '-c', ECHO_SCRIPT)
+
+    def tearDown(self):
+        """Terminate after each test"""
+        self.server.terminate()
+
+    async def test_read_write(self):
+        """Read the prompt, write a line and read the reply until exit."""
+        data = b''
+        while b'ready' not in data:
+            data += await self.server.read()
+        self.server.write(b'hello\n')
+        await self.server.drain()
+        output = bytearray()
+        async for chunk in self.server:
+            output += chunk
+        self.assertIn(b'HELLO', output)
+        self.assertEqual(b'', await self.server.read())
+
+    async def test_timeout(self):
+        """A read times out with None when nothing arrives."""
+        data = b''
+        while b'ready\r\n' not in data:
+            data += await self.server.read()
+        self.assertIsNone(await self.server.read(timeout=0.1))
+
+    async def test_concurrent(self):
+        """Drive several subprocesses at once from the one event loop."""
+        others = [server.AsyncSubprocessNethack(sys.executable, '-c', ECHO_SCRIPT)
+                  for _ in range(4)]
+        async def run(nethack, word):
+            """Send the word and return all the output"""
+            nethack.write(word + b'\n')
+            await nethack.drain()
+            output = bytearray()
+            async for chunk in nethack:
+                output += chunk
+            return output
+        try:
+            outputs = await asyncio.gather(*(run(nethack, b'game%d' % i)
+                                             for (i, nethack) in enumerate(others)))
+        finally:
+            for nethack in others:
+                nethack.terminate()
+        for (i, output) in enumerate(outputs):
+            self.assertIn(b'GAME%d' % i, output)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+"""Read the bottom status lines of the nethack screen (St, Dx, HP, Pw, AC,
+   Dlvl, T...) into a Status. This is a port of the Status class from the
+   old parser."""
+
+import collections
+import re
+
+import screen
+
+# Status line regexes, the score and turn counter are optional in nethack
+STATUS1_RE = re.compile(rb'^(.*) the ([^ ]*) *'
+                        rb'St:([1-9][0-9]?)(?:/([0-9][0-9]|\*\*))? Dx:([1-9][0-9]?) '
+                        rb'Co:([1-9][0-9]?) In:([1-9][0-9]?) Wi:([1-9][0-9]?) '
+                        rb'Ch:([1-9][0-9]?) *([^ ]*)(?: *S:([0-9]+))?')
+STATUS2_RE = re.compile(rb'^Dlvl:(-?[1-9][0-9]?) *\$:([0-9]+) *'
+                        rb'HP:([0-9]+)\(([0-9]+)\) *Pw:([0-9]+)\(([0-9]+)\) *'
+                        rb'AC:(-?[0-9]+) *Xp:([0-9]+)/([0-9]+)(?: *T:([0-9]+))? *'
+                        rb'([^ ]*(?: [^ ]+)*)?')
+
+# The status lines are the last two rows of the status window
+STATUS_ROWS = (screen.ROWS - 1, screen.ROWS)
+
+# The parsed status lines. The names are strings, effects is a tuple of
+# strings and the rest are ints. str_percent is None unless strength is 18/xx,
+# 100 for 18/**. score and turns are None if nethack isn't showing them.
+Status = collections.namedtuple('Status', (
+    'player', 'rank', 'str', 'str_percent', 'dex', 'con', 'int', 'wis', 'cha', 'align',
+    'score', 'dungeon_level', 'gold', 'hp', 'hpmax', 'pw', 'pwmax', 'ac', 'xp_level', 'xp',
+    'turns', 'effects'))
+
+def _optional_int(group):
+    """Internal function: int of a regex group that may not have matched"""
+    return None if group is None else int(group)
+
+def parse_status(line1, line2):
+    """Parse the two status lines (bytes) into a Status. Returns None if
+       either line isn't a status line."""
+    match1 = STATUS1_RE.match(line1)
+    match2 = STATUS2_RE.match(line2)
+    if match1 is None or match2 is None:
+        return None
+    str_percent = match1.group(4)
+    if str_percent == b'**':
+        str_percent = 100
+    return Status(player=match1.group(1).decode('ascii', 'replace'),
+                  rank=match1.group(2).decode('ascii', 'replace'),
+                  str=int(match1.group(3)),
+                  str_percent=_optional_int(str_percent),
+                  dex=int(match1.group(5)),
+                  con=int(match1.group(6)),
+                  int=int(match1.group(7)),
+                  wis=int(match1.group(8)),
+                  cha=int(match1.group(9)),
+                  align=match1.group(10).decode('ascii', 'replace'),
+                  score=_optional_int(match1.group(11)),
+                  dungeon_level=int(match2.group(1)),
+                  gold=int(match2.group(2)),
+                  hp=int(match2.group(3)),
+                  hpmax=int(match2.group(4)),
+                  pw=int(match2.group(5)),
+                  pwmax=int(match2.group(6)),
+                  ac=int(match2.group(7)),
+                  xp_level=int(match2.group(8)),
+                  xp=int(match2.group(9)),
+                  turns=_optional_int(match2.group(10)),
+                  effects=tuple(match2.group(11).decode('ascii', 'replace').split())
+                  if match2.group(11) else ())
+
+def _status_lines(window):
+    """Internal function: the status lines of the window as bytes, with
+       empty characters as spaces"""
+    lines = list()
+    for y in STATUS_ROWS:
+        start = y*screen.STRIDE + 1
+        lines.append(window.chars[start:start + screen.COLUMNS].tobytes().replace(b'\0', b' '))
+    return tuple(lines)
+
+class StatusReader:
+    """Reads the Status from the status lines of a ScreenData. The lines are
+       only parsed again when they change, otherwise the same Status is
+       returned. Checking for a change is O(1) while the status window is
+       unchanged (its content_hash), and a compare of the two rows otherwise."""
+
+    def __init__(self, screen_data, window=screen.STATUS_WINDOW):
+        """Read from the given window of the screen_data. Without tiledata
+           nethack draws everything in the base window, so read that one."""
+        self.screen_data = screen_data
+        self.window = window
+        self._content_hash = None
+        self._lines = None
+        self._status = None
+
+    def read(self):
+        """Return the current Status, or None if the status lines can't be parsed."""
+        window = self.screen_data.windows[self.window]
+        if window.content_hash != self._content_hash:
+            self._content_hash = window.content_hash
+            lines = _status_lines(window)
+            if lines != self._lines:
+                self._lines = lines
+                self._status = parse_status(lines[0], lines[1])
+        return self._status
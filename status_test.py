@@ -0,0 +1,70 @@
+"""unittests for the status module"""
+
+import unittest
+
+import screen
+import status
+
+LINE1 = b'Agent the Stripling          St:18/50 Dx:14 Co:17 In:8 Wi:10 Ch:7 Lawful S:120'
+LINE2 = b'Dlvl:1 $:0 HP:16(16) Pw:2(2) AC:6 Xp:1/0 T:42 Burdened Hungry'
+
+class TestStatus(unittest.TestCase):
+    """Test reading the status lines."""
+
+    def setUp(self):
+        self.screen = screen.ScreenData()
+        self.reader = status.StatusReader(self.screen)
+
+    def write_line(self, y, line):
+        """Draw the line at row y of the status window, clearing the rest of the row"""
+        self.screen.current_window = screen.STATUS_WINDOW
+        self.screen.clear_rows(y, y)
+        self.screen.cursor_x = 1
+        self.screen.cursor_y = y
+        self.screen.write_run(line)
+
+    def test_parse_status(self):
+        """Test parsing the status lines, including the optional fields."""
+        stats = status.parse_status(LINE1, LINE2)
+        self.assertEqual(status.Status(
+            player='Agent', rank='Stripling', str=18, str_percent=50, dex=14, con=17, int=8,
+            wis=10, cha=7, align='Lawful', score=120, dungeon_level=1, gold=0, hp=16, hpmax=16,
+            pw=2, pwmax=2, ac=6, xp_level=1, xp=0, turns=42, effects=('Burdened', 'Hungry')),
+            stats)
+
+        stats = status.parse_status(b'Agent the Hero St:18/** Dx:14 Co:17 In:8 Wi:10 Ch:7 '
+                                    b'Chaotic',
+                                    b'Dlvl:-2 $:5 HP:1(30) Pw:0(9) AC:-3 Xp:9/2000')
+        self.assertEqual((100, None, -2, -3, None, ()),
+                         (stats.str_percent, stats.score, stats.dungeon_level, stats.ac,
+                          stats.turns, stats.effects))
+        self.assertIsNone(status.parse_status(b'--More--', LINE2))
+        # fields cut short while nethack redraws the line aren't numbers
+        self.assertIsNone(status.parse_status(
+            LINE1, b'Dlvl:1 $: HP:(16) Pw:2(2) AC:6 Xp:1/0 T:42'))
+        self.assertIsNone(status.parse_status(
+            LINE1, b'Dlvl:1 $:0 HP:16(16) Pw:2(2) AC:- Xp:1/0 T:42'))
+
+    def test_reader(self):
+        """The status is only parsed again when the status lines change."""
+        self.assertIsNone(self.reader.read())
+        self.write_line(23, LINE1)
+        self.write_line(24, LINE2)
+        stats = self.reader.read()
+        self.assertEqual((16, 42), (stats.hp, stats.turns))
+        self.assertIs(stats, self.reader.read())
+
+        # other rows of the window don't cause a parse
+        self.write_line(1, b'Hello')
+        self.assertIs(stats, self.reader.read())
+
+        # redrawing the same text doesn't change anything either
+        self.write_line(24, LINE2)
+        self.assertIs(stats, self.reader.read())
+
+        self.write_line(24, LINE2.replace(b'HP:16', b'HP:9').replace(b'T:42', b'T:43'))
+        stats = self.reader.read()
+        self.assertEqual((9, 43), (stats.hp, stats.turns))
+
+if __name__ == '__main__':
+    unittest.main()